@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Stand-in for clangd that replays LSP traffic recorded by the clangd plugin, so that
+the client side (Connection, token parsing, color variance) can be measured and tested
+on any machine, without clangd and independently of its version.
+
+Record (all requests of all connections are stored, multiple runs can share 1 file):
+
+CLANGD_RECORD=recording.jsonl python plugins/clangd.py path/to/file.cpp ...
+
+Replay (the executable is selected just like real clangd, launch arguments other than
+--version are ignored):
+
+CLANGD=benchmarks/fake_clangd.py FAKE_CLANGD_RECORDING=recording.jsonl python plugins/clangd.py path/to/file.cpp ...
+
+Requests are matched to recorded responses by method, parameters and the content of the
+document they refer to (not its URI) so the recording does not depend on the directory
+it was made in. A request that was not recorded gets an error response - record again
+after changing which requests the client sends. Server-initiated messages (notifications
+such as diagnostics) are not replayed.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from typing import Any, Dict, Optional, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from plugins.clangd import LspFrameParser, lsp_make_message
+
+RECORDING_ENV = "FAKE_CLANGD_RECORDING"
+
+# printed for --version, which the plugin uses (without starting a server) as part of the cache key
+VERSION_OUTPUT = "fake_clangd (replay of recorded clangd traffic) version 1"
+
+# https://microsoft.github.io/language-server-protocol/specifications/lsp/3.17/specification/#errorCodes
+JSON_RPC_ERROR_INTERNAL_ERROR = -32603
+
+# content of open documents: URI => hash of the text
+Documents = Dict[str, str]
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def update_documents(documents: Documents, method: str, params: Any) -> None:
+    if method == "textDocument/didOpen":
+        document = params["textDocument"]
+        documents[document["uri"]] = text_hash(document["text"])
+    elif method == "textDocument/didChange":
+        # full synchronization - the last change contains the whole text
+        documents[params["textDocument"]["uri"]] = text_hash(params["contentChanges"][-1]["text"])
+    elif method == "textDocument/didClose":
+        documents.pop(params["textDocument"]["uri"], None)
+
+
+def request_key(documents: Documents, method: str, params: Any) -> str:
+    if method == "initialize":
+        # contains process ID
+        return method
+    if isinstance(params, dict) and "textDocument" in params:
+        params = dict(params)
+        params["textDocument"] = documents.get(params["textDocument"]["uri"])
+    return method + json.dumps(params, sort_keys=True, indent=None, separators=(",", ":"))
+
+
+# request key => response without jsonrpc and id members
+def load_recording(path: str) -> Dict[str, Dict[str, Any]]:
+    documents: Dict[str, Documents] = {}
+    requests: Dict[Tuple[str, Any], str] = {}
+    result = {}
+
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            entry = json.loads(line)
+            connection = entry["connection"]
+            message = entry["message"]
+            method = message.get("method")
+
+            if entry["direction"] == "send":
+                if method is None:
+                    continue # client's response to a server request
+                connection_documents = documents.setdefault(connection, {})
+                if "id" in message:
+                    requests[(connection, message["id"])] = request_key(connection_documents, method, message.get("params"))
+                else:
+                    update_documents(connection_documents, method, message.get("params"))
+            elif method is None:
+                key = requests.pop((connection, message.get("id")), None)
+                if key is not None:
+                    result[key] = {name: value for name, value in message.items() if name not in ("jsonrpc", "id")}
+
+    return result
+
+
+class ReplayServer:
+    def __init__(self, responses: Dict[str, Dict[str, Any]]):
+        self.responses = responses
+        self.documents: Documents = {}
+        self.parser = LspFrameParser()
+
+    def send(self, message: Dict[str, Any]) -> None:
+        sys.stdout.buffer.write(lsp_make_message(message))
+        sys.stdout.buffer.flush()
+
+    def receive(self) -> Optional[Dict[str, Any]]:
+        while True:
+            message = self.parser.next_message()
+            if message is not None:
+                return message
+
+            data = os.read(sys.stdin.fileno(), 1 << 16)
+            if not data:
+                return None
+            self.parser.feed(data)
+
+    def respond(self, message: Dict[str, Any]) -> None:
+        method = message["method"]
+        response = self.responses.get(request_key(self.documents, method, message.get("params")))
+        if response is None:
+            if method == "shutdown":
+                response = {"result": None}
+            else:
+                response = {"error": {"code": JSON_RPC_ERROR_INTERNAL_ERROR, "message": f"{method}: request was not recorded"}}
+        self.send({"jsonrpc": "2.0", "id": message["id"], **response})
+
+    def run(self) -> None:
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+
+            method = message.get("method")
+            if method is None:
+                continue # response to a server request - none are sent
+            if "id" in message:
+                self.respond(message)
+            elif method == "exit":
+                return
+            else:
+                update_documents(self.documents, method, message.get("params"))
+
+
+def main():
+    if "--version" in sys.argv[1:]:
+        print(VERSION_OUTPUT)
+        return
+
+    path = os.environ.get(RECORDING_ENV)
+    if not path:
+        print(f"specify env variable {RECORDING_ENV} with the path to the recording", file=sys.stderr)
+        exit(1)
+
+    ReplayServer(load_recording(path)).run()
+
+
+if __name__ == "__main__":
+    main()
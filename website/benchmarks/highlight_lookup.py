@@ -0,0 +1,86 @@
+"""
+Microbenchmark of matching textDocument/documentHighlight ranges to semantic tokens
+(clangd.document_highlight_find_matching_token_indexes, called for every highlight during
+color variance): bisect over (line, column) tuples created on every probe vs bisect over
+the packed integer position keys of clangd.SemanticTokens.
+
+Tokens and highlights are random but shaped like real code (a few tokens per line,
+each highlight covering 1 token). The time of building the key index is included.
+Run from the directory with conf.py:
+
+python benchmarks/highlight_lookup.py [number of lines] [number of highlights]
+"""
+
+import os
+import random
+import sys
+import time
+from bisect import bisect_left, bisect_right
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from plugins.clangd import document_highlight_find_matching_token_indexes, lsp_make_range, parse_semantic_token_data
+
+
+# the implementation that preceded position keys
+class KeyWrapper:
+    def __init__(self, iterable, key):
+        self.iterable = iterable
+        self.key = key
+
+    def __getitem__(self, i):
+        return self.key(self.iterable[i])
+
+    def __len__(self):
+        return len(self.iterable)
+
+def find_matching_token_indexes_tuples(highlight, semantic_tokens):
+    start = highlight["range"]["start"]
+    end = highlight["range"]["end"]
+    positions = KeyWrapper(range(len(semantic_tokens)), semantic_tokens.position)
+    l = bisect_left(positions, (start["line"], start["character"]))
+    r = bisect_right(positions, (end["line"], end["character"]))
+    return l, r
+
+
+def make_data(num_lines: int) -> list:
+    random.seed(0)
+    data = []
+    for line in range(num_lines):
+        delta_line = 1
+        for _ in range(random.randint(0, 8)):
+            data.extend((delta_line, random.randint(1, 12), random.randint(1, 10), random.randint(0, 20), 0))
+            delta_line = 0
+    return data
+
+
+def make_highlights(semantic_tokens, num_highlights: int) -> list:
+    highlights = []
+    for _ in range(num_highlights):
+        token = semantic_tokens[random.randrange(len(semantic_tokens))]
+        highlights.append({"range": lsp_make_range(token.line, token.column, token.line, token.column + token.length)})
+    return highlights
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_highlights = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+
+    data = make_data(num_lines)
+    highlights = make_highlights(parse_semantic_token_data(data), num_highlights)
+    print(f"{len(data) // 5} tokens in {num_lines} lines, {num_highlights} highlights")
+
+    results = {}
+    for name, function in (("(line, column) tuples", find_matching_token_indexes_tuples),
+        ("packed position keys", document_highlight_find_matching_token_indexes)):
+        # fresh tokens so that building the key index is measured too
+        semantic_tokens = parse_semantic_token_data(data)
+        start = time.perf_counter()
+        results[name] = [function(highlight, semantic_tokens) for highlight in highlights]
+        print(f"{name:<22}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    baseline, *others = results.values()
+    assert all(result == baseline for result in others)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark of receiving LSP messages from a child process through a pipe, like messages
+from clangd: the reader that preceded the asyncio connection (blocking readline of
+headers and read of the body from Popen's buffered stdout) vs Connection's reader
+(clangd.LspFrameParser fed by an asyncio subprocess pipe with large reads).
+
+Input is a stream of textDocument/semanticTokens/full responses (the largest messages
+clangd sends during the build) interleaved with notifications, written by a child
+process in 64 KiB chunks. Each variant is measured with and without JSON decoding
+(the latter shows the cost of framing and pipe I/O alone). Run from the directory
+with conf.py:
+
+python benchmarks/lsp_framing.py [number of tokens per response] [number of responses]
+
+Both readers take the same time within run-to-run noise (up to about 25%), also for 4 MB
+responses (200000 tokens each); most of the total is JSON decoding. LspFrameParser
+does not make receiving faster - it exists because the asyncio reader must not block
+on readline while other coroutines use the loop.
+"""
+
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from plugins.clangd import HEADER_CONTENT_LENGTH, LspFrameParser, RECEIVE_CHUNK_SIZE, json_rpc_is_notification, lsp_make_message
+
+WRITER_CODE = """
+import sys
+with open(sys.argv[1], "rb") as file:
+    data = file.read()
+for i in range(0, len(data), 1 << 16):
+    sys.stdout.buffer.write(data[i:i + (1 << 16)])
+    sys.stdout.buffer.flush()
+"""
+
+
+def make_stream(num_tokens: int, num_responses: int) -> bytes:
+    random.seed(0)
+    messages = []
+    for id in range(1, num_responses + 1):
+        data = []
+        for _ in range(num_tokens):
+            data.extend((random.randint(0, 2), random.randint(0, 40), random.randint(1, 20), random.randint(0, 20), random.randint(0, 512)))
+        messages.append(lsp_make_message({"jsonrpc": "2.0", "id": id, "result": {"data": data}}))
+        messages.append(lsp_make_message({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics",
+            "params": {"uri": "file:///foo.cpp", "diagnostics": []}}))
+    return b"".join(messages)
+
+
+def writer_args(stream_path: str) -> list:
+    return [sys.executable, "-c", WRITER_CODE, stream_path]
+
+
+# the implementation that preceded the asyncio connection (Connection.receive)
+def count_popen(stream_path: str) -> int:
+    process = subprocess.Popen(writer_args(stream_path), stdout=subprocess.PIPE)
+    count = 0
+    while True:
+        headers = []
+        while True:
+            line = process.stdout.readline()
+            if line == b"\r\n" or not line:
+                break
+            headers.append(line)
+        if not headers:
+            break
+
+        length = 0
+        for hdr in headers:
+            hdr = hdr.decode()
+            if HEADER_CONTENT_LENGTH in hdr:
+                length = int(hdr.removeprefix(HEADER_CONTENT_LENGTH))
+                break
+
+        message = json.loads(process.stdout.read(length).decode())
+        if not json_rpc_is_notification(message):
+            count += 1
+    process.wait()
+    return count
+
+
+# Connection._receive
+async def count_parser_async(stream_path: str) -> int:
+    process = await asyncio.create_subprocess_exec(*writer_args(stream_path), stdout=asyncio.subprocess.PIPE)
+    parser = LspFrameParser()
+    count = 0
+    while True:
+        message = parser.next_message()
+        if message is None:
+            data = await process.stdout.read(max(RECEIVE_CHUNK_SIZE, parser.bytes_needed()))
+            if not data:
+                break
+            parser.feed(data)
+        elif not json_rpc_is_notification(message):
+            count += 1
+    await process.wait()
+    return count
+
+
+def count_parser(stream_path: str) -> int:
+    return asyncio.run(count_parser_async(stream_path))
+
+
+def measure(stream_path: str, count_responses, expected: int) -> float:
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        count = count_responses(stream_path)
+        seconds = time.perf_counter() - start
+        assert count == expected
+        best = min(best, seconds)
+    return best
+
+
+def main() -> None:
+    num_tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_responses = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    stream = make_stream(num_tokens, num_responses)
+    print(f"{num_responses} responses with {num_tokens} tokens each, {len(stream) / 1e6:.1f} MB in total")
+
+    with tempfile.NamedTemporaryFile(suffix=".lsp") as file:
+        file.write(stream)
+        file.flush()
+
+        variants = (("Popen readline", count_popen), ("asyncio + LspFrameParser", count_parser))
+        results = {}
+        for decode in (True, False):
+            original_loads = json.loads
+            if not decode:
+                json.loads = lambda body: {"id": 1}
+            try:
+                for name, count_responses in variants:
+                    results[(name, decode)] = measure(file.name, count_responses, num_responses * (1 if decode else 2))
+            finally:
+                json.loads = original_loads
+
+    for name, _ in variants:
+        total = results[(name, True)]
+        framing = results[(name, False)]
+        print(f"{name:<24}: total {total * 1000:8.1f} ms ({len(stream) / 1e6 / total:7.1f} MB/s), "
+            f"without JSON {framing * 1000:8.1f} ms ({len(stream) / 1e6 / framing:7.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark of the client side of clangd highlighting - Connection, semantic token parsing
+and color variance - against benchmarks/fake_clangd.py replaying a recording (see that
+file for how to record). Server time is close to 0 so the results reflect only the client.
+
+Each file is processed by 1 clangd instance, sequentially, the given number of times
+(each time the document is opened and closed, like during the build). Reported: LSP requests per second, bytes parsed
+and per-file latency split into semantic tokens (request + parsing) and color variance.
+Run from the directory with conf.py:
+
+python benchmarks/lsp_pipeline.py recording.jsonl [number of rounds] path/to/file.cpp ...
+"""
+
+import os
+import statistics
+import sys
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARKS_PATH, ".."))
+from fake_clangd import RECORDING_ENV
+from plugins.clangd import Clangd, Connection, LspFrameParser
+
+
+class Counters:
+    requests = 0
+    bytes_parsed = 0
+
+
+# count traffic without changing the client
+def install_counters() -> None:
+    send_request = Connection._send_request
+    feed = LspFrameParser.feed
+
+    async def counted_send_request(self, method, params):
+        Counters.requests += 1
+        return await send_request(self, method, params)
+
+    def counted_feed(self, data):
+        Counters.bytes_parsed += len(data)
+        feed(self, data)
+
+    Connection._send_request = counted_send_request
+    LspFrameParser.feed = counted_feed
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:8.2f} ms"
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        exit(1)
+
+    os.environ["CLANGD"] = os.path.join(BENCHMARKS_PATH, "fake_clangd.py")
+    os.environ[RECORDING_ENV] = os.path.abspath(sys.argv[1])
+    rounds = int(sys.argv[2]) if sys.argv[2].isdigit() else 1
+    paths = sys.argv[3:] if sys.argv[2].isdigit() else sys.argv[2:]
+
+    clangd = Clangd()
+    install_counters()
+
+    tokens_times = {path: [] for path in paths}
+    variance_times = {path: [] for path in paths}
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for path in paths:
+            file_content = clangd.text_document_open(path)
+            tokens_start = time.perf_counter()
+            semantic_tokens = clangd.semantic_tokens(path)
+            variance_start = time.perf_counter()
+            clangd.apply_color_variance(path, file_content, semantic_tokens)
+            variance_end = time.perf_counter()
+            clangd.text_document_close(path)
+            tokens_times[path].append(variance_start - tokens_start)
+            variance_times[path].append(variance_end - variance_start)
+    total = time.perf_counter() - start
+    clangd.close()
+
+    print(f"{len(paths)} files x {rounds} rounds: {format_ms(total)}")
+    print(f"requests: {Counters.requests} ({Counters.requests / total:.0f}/s)")
+    print(f"bytes parsed: {Counters.bytes_parsed} ({Counters.bytes_parsed / total / 1e6:.1f} MB/s)")
+    print("median per file latency (semantic tokens, color variance):")
+    for path in paths:
+        print(f"{format_ms(statistics.median(tokens_times[path]))} {format_ms(statistics.median(variance_times[path]))}  {path}")
+
+
+if __name__ == "__main__":
+    main()
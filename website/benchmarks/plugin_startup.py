@@ -0,0 +1,49 @@
+"""
+Startup time of the rest_highlighter plugin as seen by Nikola commands that load plugins
+but do not build anything (check, serve, build with everything up to date): module import
+plus RestHighlighter.set_site. The "eager" variant additionally starts clangd right away,
+which is what the plugin did before clangd was started on the first use of the directive.
+
+Each measurement runs in a fresh interpreter so that imports are not cached. Requires ACH
+and clangd (otherwise clangd startup fails immediately and both variants are equal).
+Run from the directory with conf.py:
+
+python benchmarks/plugin_startup.py [number of runs]
+"""
+
+import statistics
+import subprocess
+import sys
+
+CHILD_CODE = """
+import sys, time, types
+import conf
+start = time.perf_counter()
+import plugins.rest_highlighter as rh
+site = types.SimpleNamespace(config={{"CLANGD_LAUNCH_PROFILE": conf.CLANGD_LAUNCH_PROFILE}}, debug=False)
+rh.RestHighlighter().set_site(site)
+if {eager}:
+    rh.CustomCodeHighlight.get_clangd()
+print(time.perf_counter() - start)
+rh.CustomCodeHighlight.stop_clangd()
+"""
+
+
+def measure(eager: bool) -> float:
+    output = subprocess.run([sys.executable, "-c", CHILD_CODE.format(eager=eager)],
+        check=True, stdout=subprocess.PIPE, text=True).stdout
+    # plugin logs go to stderr, the last line of stdout is the measured time
+    return float(output.splitlines()[-1])
+
+
+def main():
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for name, eager in (("lazy clangd (current)", False), ("eager clangd", True)):
+        times = [measure(eager) for _ in range(num_runs)]
+        print(f"{name:<22}: median {statistics.median(times) * 1000:8.1f} ms, "
+            f"min {min(times) * 1000:8.1f} ms ({num_runs} runs)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of building and resolving the site structure (metadata.parse_site_structure,
+PageDir.sort and generate_breadcrumb for every page) on a synthetic tree of pages:
+linear search over the list of subdirectories (the implementation that preceded
+the name index) vs PageDir that indexes subdirectories by name.
+
+The tree has the given fan-out (subdirectories per directory, also non-index pages
+per directory) and is filled breadth-first until it has the given number of pages.
+Each directory has an index page. Run from the directory with conf.py:
+
+python benchmarks/site_structure.py [number of pages] [fan-out]
+"""
+
+import os
+import sys
+import time
+from typing import List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import plugins.metadata as metadata
+from plugins.metadata import PageDir, generate_breadcrumb, parse_site_structure
+
+
+# the implementation that preceded the name index
+class ListPageDir(PageDir):
+    def sort(self) -> None:
+        self._pages.sort(key=lambda page: page.permalink())
+        self._subdirs.sort(key=lambda subdir: subdir.directory_name())
+        for subdir in self.subdirs():
+            subdir.sort()
+
+    def enter_or_create(self, directory_name: str) -> PageDir:
+        for subdir in self.subdirs():
+            if subdir.directory_name() == directory_name:
+                return subdir
+
+        self.subdirs().append(ListPageDir(directory_name))
+        return self.subdirs()[-1]
+
+    def enter(self, directory_name: str) -> PageDir:
+        for subdir in self.subdirs():
+            if subdir.directory_name() == directory_name:
+                return subdir
+
+        raise RuntimeError(f'Directory "{self.directory_name()}" has no child directory "{directory_name}"!')
+
+
+# the subset of nikola.post.Post used by the structure
+class FakePage:
+    default_lang = "en"
+
+    def __init__(self, permalink: str, is_index: bool):
+        self._permalink = permalink
+        self.meta = {"en": {"index_path": "."} if is_index else {}}
+
+    def permalink(self) -> str:
+        return self._permalink
+
+    def title(self) -> str:
+        return self._permalink
+
+
+def make_pages(num_pages: int, fan_out: int) -> List[FakePage]:
+    pages = []
+    directories = ["/"]
+    for directory in directories:
+        if len(pages) >= num_pages:
+            break
+        if directory != "/":
+            pages.append(FakePage(directory, True))
+        for i in range(fan_out):
+            pages.append(FakePage(f"{directory}page_{i:03}/", False))
+            directories.append(f"{directory}dir_{i:03}/")
+    # pages come from the file system in arbitrary order
+    return sorted(pages[:num_pages], key=lambda page: hash(page.permalink()))
+
+
+def build_and_resolve(pages: List[FakePage]) -> List[list]:
+    structure = parse_site_structure(pages)
+    structure.sort()
+    return [generate_breadcrumb(page.permalink(), structure) for page in pages]
+
+
+def main():
+    num_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    fan_out = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    pages = make_pages(num_pages, fan_out)
+    print(f"{len(pages)} pages, fan-out {fan_out}")
+
+    results = {}
+    for name, page_dir_class in (("linear subdir search", ListPageDir), ("name index", PageDir)):
+        # parse_site_structure creates the root directory
+        metadata.PageDir = page_dir_class
+        start = time.perf_counter()
+        breadcrumbs = build_and_resolve(pages)
+        print(f"{name:<21}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+        results[name] = [[entry.link() for entry in breadcrumb] for breadcrumb in breadcrumbs]
+    metadata.PageDir = PageDir
+
+    baseline, *others = results.values()
+    assert all(result == baseline for result in others)
+
+
+if __name__ == "__main__":
+    main()
@@ -1464,6 +1464,19 @@ WARN_ABOUT_TAG_METADATA = False
 #     augmented_args['undefined'] = jinja2.DebugUndefined
 #     return jinja2.Environment(**augmented_args)
 
+# Xeverous: settings of clangd processes used by rest_highlighter plugin (cch directive
+#           without color_path). All keys are optional, unset ones keep clangd's defaults (flags
+#           of snippets come from .clangd next to this file). See ClangdLaunchProfile in plugins/clangd.py.
+#           - worker_threads: clangd's -j (0 = clangd's default)
+#           - pch_storage: "memory" (faster) or "disk" (less RAM) - where preambles are kept
+#           - background_index: False - snippets are independent files, indexing them is wasted work
+#           - std, compile_flags: fix flags of all snippets through a generated compile_commands.json
+#             (.clangd is still applied on top of them)
+#           - shared_pch_headers: headers precompiled once and force-included in all snippets
+#             (requires clang++ from the same LLVM installation as clangd)
+#           Example: {"pch_storage": "memory", "background_index": False, "shared_pch_headers": ["<iostream>"]}
+CLANGD_LAUNCH_PROFILE = {}
+
 # Put in global_context things you want available on all your templates.
 # It can be anything, data, functions, modules, etc.
 GLOBAL_CONTEXT = {}
@@ -0,0 +1,223 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict, Iterator, Optional, Tuple
+
+# same directory as Nikola's CACHE_FOLDER, relative to conf.py (ignored by git)
+CACHE_PATH = "cache"
+
+
+def hash_strings(*parts: str) -> str:
+    hasher = hashlib.sha256()
+    for part in parts:
+        encoded = part.encode()
+        # length prefix so that ("ab", "c") and ("a", "bc") produce different hashes
+        hasher.update(len(encoded).to_bytes(8, "little"))
+        hasher.update(encoded)
+    return hasher.hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed storage of text values that persists between builds
+
+    Each entry is a separate file named after its key (a hash). Entries are
+    never modified, only written once and replaced - the key should already
+    cover everything that the value depends on.
+
+    With max_size (in bytes) the cache is bounded: hits update modification time
+    of the entry and trim() removes least recently used entries until the total
+    size fits. Hits and misses are counted (per process).
+    """
+
+    def __init__(self, name: str, extension: str = "txt", max_size: Optional[int] = None):
+        self._directory = os.path.join(CACHE_PATH, name)
+        self._extension = extension
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def directory(self) -> str:
+        return self._directory
+
+    def entry_path(self, key: str) -> str:
+        # split into subdirectories to avoid huge directory listings
+        return os.path.join(self._directory, key[:2], f"{key}.{self._extension}")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                value = file.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self.max_size is not None:
+            # modification time is the time of last use (atime is often disabled)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return value
+
+    def contains(self, key: str) -> bool:
+        """Whether the entry exists, without counting it as a hit or a miss."""
+        return os.path.exists(self.entry_path(key))
+
+    def put(self, key: str, value: str) -> None:
+        write_file_atomically(self.entry_path(key), value.encode())
+
+    def trim(self) -> int:
+        """Remove least recently used entries that exceed max_size, return their number."""
+        if self.max_size is None:
+            return 0
+
+        entries = []
+        total_size = 0
+        suffix = f".{self._extension}"
+        for directory, _, names in os.walk(self._directory):
+            for name in names:
+                if not name.endswith(suffix):
+                    continue # temporary files of unfinished writes
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # removed by another process
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total_size += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+        return removed
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)"
+
+
+def write_file_atomically(path: str, content: bytes) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # doit can run tasks in multiple processes - write to a temporary file
+    # and rename it so that no reader can ever observe a partially written file
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class StringTable:
+    """
+    Read-only string => string mapping stored in a binary file and memory-mapped
+
+    All processes that open the same file share 1 copy of it (the OS page cache)
+    and nothing is parsed upfront - lookups binary search the sorted index in place.
+    The file also stores the key (a hash) of everything the table was built from,
+    a table with a different key is treated as missing.
+
+    Layout (little endian): header (magic, key, number of entries), index (for each
+    entry sorted by UTF-8 bytes of its key: key offset, key length, value offset,
+    value length) and then UTF-8 data.
+    """
+
+    MAGIC = b"STB1"
+    HEADER = struct.Struct("<4s64sI")
+    ENTRY = struct.Struct("<IIII")
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._data) < StringTable.HEADER.size:
+                raise ValueError(f"{path}: file too small for a string table")
+            magic, key, self._size = StringTable.HEADER.unpack_from(self._data, 0)
+            if magic != StringTable.MAGIC:
+                raise ValueError(f"{path}: not a string table")
+            if len(self._data) < StringTable.HEADER.size + self._size * StringTable.ENTRY.size:
+                raise ValueError(f"{path}: string table is truncated")
+            self.key = key.decode()
+        except BaseException:
+            self._data.close()
+            raise
+
+    @staticmethod
+    def open(path: str, key: str) -> Optional["StringTable"]:
+        """Return the table if it exists, is valid and has been built for the given key."""
+        try:
+            table = StringTable(path)
+        except (OSError, ValueError):
+            return None
+        if table.key != key:
+            table.close()
+            return None
+        return table
+
+    @staticmethod
+    def write(path: str, key: str, mapping: Dict[str, str]) -> None:
+        items = sorted((name.encode(), value.encode()) for name, value in mapping.items())
+        data_offset = StringTable.HEADER.size + len(items) * StringTable.ENTRY.size
+        header = StringTable.HEADER.pack(StringTable.MAGIC, key.encode(), len(items))
+        index = bytearray()
+        data = bytearray()
+        for name, value in items:
+            name_offset = data_offset + len(data)
+            data += name
+            index += StringTable.ENTRY.pack(name_offset, len(name), data_offset + len(data), len(value))
+            data += value
+        write_file_atomically(path, header + index + data)
+
+    def close(self) -> None:
+        self._data.close()
+
+    def _entry(self, i: int) -> Tuple[int, int, int, int]:
+        return StringTable.ENTRY.unpack_from(self._data, StringTable.HEADER.size + i * StringTable.ENTRY.size)
+
+    def _key(self, i: int) -> bytes:
+        offset, length, _, _ = self._entry(i)
+        return self._data[offset:offset + length]
+
+    def _value(self, i: int) -> str:
+        _, _, offset, length = self._entry(i)
+        return self._data[offset:offset + length].decode()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._size):
+            yield self._key(i).decode()
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        encoded = name.encode()
+        l, r = 0, self._size
+        while l < r:
+            m = (l + r) // 2
+            if self._key(m) < encoded:
+                l = m + 1
+            else:
+                r = m
+        if l < self._size and self._key(l) == encoded:
+            return self._value(l)
+        return default
@@ -1,11 +1,31 @@
+from array import array
 from bisect import bisect_left, bisect_right
 import os
 import json
-import subprocess
+import asyncio
+import glob
+import queue
+import re
 import shutil
+import subprocess
 import sys
-from typing import Callable, Sequence, Union, Any
-from file_utils import read_file
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import accumulate, count
+from typing import Callable, Iterator, Optional, Sequence, Union, Any
+
+# run as a script (python plugins/clangd.py): make the plugins package importable, just like
+# Nikola does by adding the directory with conf.py to sys.path
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plugins.file_utils import read_file
+from plugins.cache_utils import CACHE_PATH, DiskCache, hash_strings
+from plugins.tracing import span
 from nikola.utils import get_logger
 
 DEBUG = os.environ.get("CLANGD_DEBUG") is not None
@@ -81,6 +101,71 @@ def json_rpc_response_extract_result(response: dict[str, Any], id: Union[str, in
 
 
 HEADER_CONTENT_LENGTH = "Content-Length: "
+HEADER_CONTENT_LENGTH_BYTES = HEADER_CONTENT_LENGTH.encode()
+HEADERS_END_BYTES = b"\r\n\r\n"
+
+# Incremental parser of LSP base protocol frames: headers followed by a JSON body.
+# https://microsoft.github.io/language-server-protocol/specifications/lsp/3.17/specification/#baseProtocol
+# Data is fed in whatever chunks the pipe returns, so that the connection's reader never has
+# to wait for a line or a body while other coroutines need the loop. Receiving takes about
+# as long as with the blocking reader it replaced (see benchmarks/lsp_framing.py) - the cost
+# is dominated by JSON decoding, not by framing.
+class LspFrameParser:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0 # beginning of not yet parsed data
+        self.body_start = -1 # body boundaries of the frame whose header has been parsed
+        self.body_end = -1
+        self.last_frame_size = 0 # headers + body of the message returned by next_message
+
+    def feed(self, data: bytes) -> None:
+        # drop consumed data only if it's at least half of the buffer - this way
+        # bytes are moved amortized O(1) times and the buffer is not reallocated per message
+        if self.position and self.position * 2 >= len(self.buffer):
+            del self.buffer[:self.position]
+            if self.body_start >= 0:
+                self.body_start -= self.position
+                self.body_end -= self.position
+            self.position = 0
+        self.buffer += data
+
+    def _parse_header(self) -> bool:
+        headers_end = self.buffer.find(HEADERS_END_BYTES, self.position)
+        if headers_end < 0:
+            return False
+
+        length_start = self.buffer.find(HEADER_CONTENT_LENGTH_BYTES, self.position, headers_end)
+        if length_start < 0:
+            raise RuntimeError(f'invalid or missing "{HEADER_CONTENT_LENGTH}" header')
+        length_start += len(HEADER_CONTENT_LENGTH_BYTES)
+        length_end = self.buffer.find(b"\r\n", length_start, headers_end + 2)
+        # int() accepts bytes-like objects directly
+        length = int(self.buffer[length_start:length_end])
+        if length <= 0:
+            raise RuntimeError(f'invalid or missing "{HEADER_CONTENT_LENGTH}" header')
+
+        self.body_start = headers_end + len(HEADERS_END_BYTES)
+        self.body_end = self.body_start + length
+        return True
+
+    # number of bytes missing to complete the frame whose header has been parsed
+    def bytes_needed(self) -> int:
+        return max(0, self.body_end - len(self.buffer))
+
+    # return next complete message or None if more data is needed
+    def next_message(self) -> Optional[Any]:
+        if self.body_start < 0 and not self._parse_header():
+            return None
+        if self.body_end > len(self.buffer):
+            return None
+
+        with memoryview(self.buffer) as view:
+            body = str(view[self.body_start:self.body_end], "utf-8")
+        self.last_frame_size = self.body_end - self.position
+        self.position = self.body_end
+        self.body_start = -1
+        self.body_end = -1
+        return json.loads(body)
 
 def lsp_make_message(json_rpc_object: dict[str, Any]) -> bytes:
     body = json.dumps(json_rpc_object, indent=None).encode()
@@ -132,84 +217,478 @@ def get_clangd_path() -> str:
     raise RuntimeError("clangd not found. Specify env variable CLANGD that points to the executable or to a name searchable in PATH")
 
 
+# Settings of launched clangd processes, configured in conf.py (CLANGD_LAUNCH_PROFILE).
+# Unset settings keep clangd's defaults - an empty profile launches clangd with only --log=error.
+# https://clangd.llvm.org/config (compile flags also come from .clangd file next to conf.py)
+#
+# Flags for snippets can additionally be fixed through a generated compile_commands.json
+# (all C++ sources and headers in pages directory). Optionally, a precompiled header with commonly used
+# standard library headers can be built (with clang from the same LLVM installation as clangd)
+# and force-included in every snippet - the headers are then parsed once for the whole site
+# instead of once per snippet preamble. Versions of clangd which drop PCH flags from compile
+# commands will simply ignore it.
+CLANGD_PROFILE_CACHE_PATH = os.path.join(CACHE_PATH, "clangd_profile")
+CLANGD_PROFILE_SOURCES_GLOB = "pages/**/*"
+# files that cch directives highlight with clangd (it opens every file as C++)
+CLANGD_PROFILE_SOURCE_EXTENSIONS = (".cpp", ".hpp", ".h")
+
+class ClangdLaunchProfile:
+    def __init__(self,
+        worker_threads: int = 0, # clangd -j, 0 means clangd's default
+        pch_storage: Optional[str] = None, # where clangd keeps preambles: "memory" or "disk"
+        background_index: Optional[bool] = None, # snippets are independent, no need to index them
+        std: Optional[str] = None, # e.g. "c++17"
+        compile_flags: Sequence[str] = (),
+        shared_pch_headers: Sequence[str] = () # e.g. ["<iostream>", "<string>"]
+    ):
+        if pch_storage not in (None, "memory", "disk"):
+            raise RuntimeError(f'clangd launch profile: pch_storage should be "memory" or "disk", not "{pch_storage}"')
+        if worker_threads < 0:
+            raise RuntimeError(f"clangd launch profile: worker_threads can not be negative: {worker_threads}")
+
+        self.worker_threads = worker_threads
+        self.pch_storage = pch_storage
+        self.background_index = background_index
+        self.std = std
+        self.compile_flags = list(compile_flags)
+        self.shared_pch_headers = list(shared_pch_headers)
+
+    @staticmethod
+    def from_config(config: Optional[dict[str, Any]]) -> "ClangdLaunchProfile":
+        if config is None:
+            return ClangdLaunchProfile()
+        try:
+            return ClangdLaunchProfile(**config)
+        except TypeError as err:
+            raise RuntimeError(f"invalid clangd launch profile {config}: {str(err)}")
+
+    def uses_compile_commands(self) -> bool:
+        return self.std is not None or len(self.compile_flags) > 0 or len(self.shared_pch_headers) > 0
+
+    def launch_args(self) -> list[str]:
+        args = ["--log=error"]
+        if self.pch_storage is not None:
+            args.append(f"--pch-storage={self.pch_storage}")
+        if self.background_index is not None:
+            args.append(f"--background-index={str(self.background_index).lower()}")
+        if self.worker_threads:
+            args.append(f"-j={self.worker_threads}")
+        if self.uses_compile_commands():
+            args.append(f"--compile-commands-dir={os.path.abspath(CLANGD_PROFILE_CACHE_PATH)}")
+        return args
+
+    # everything that affects clangd output, for cache keys
+    def description(self) -> str:
+        return json.dumps({
+            "launch_args": self.launch_args(),
+            "std": self.std,
+            "compile_flags": self.compile_flags,
+            "shared_pch_headers": self.shared_pch_headers
+        })
+
+    def compile_args(self) -> list[str]:
+        args = ["-xc++"]
+        if self.std:
+            args.append(f"-std={self.std}")
+        args.extend(self.compile_flags)
+        return args
+
+    # generate files referenced by launch_args, should be called once before clangd is launched
+    def prepare(self, clangd_path: str) -> None:
+        if not self.uses_compile_commands():
+            return
+
+        os.makedirs(CLANGD_PROFILE_CACHE_PATH, exist_ok=True)
+        args = self.compile_args()
+        if self.shared_pch_headers:
+            pch_path = self._build_shared_pch(clangd_path, args)
+            if pch_path:
+                args.extend(["-include-pch", pch_path])
+
+        directory = os.getcwd()
+        commands = []
+        for path in sorted(glob.glob(CLANGD_PROFILE_SOURCES_GLOB, recursive=True)):
+            if not path.endswith(CLANGD_PROFILE_SOURCE_EXTENSIONS):
+                continue
+            absolute_path = os.path.abspath(path)
+            commands.append({
+                "directory": directory,
+                "file": absolute_path,
+                "arguments": ["clang++", *args, "-c", absolute_path]
+            })
+        write_file_if_changed(os.path.join(CLANGD_PROFILE_CACHE_PATH, "compile_commands.json"), json.dumps(commands, indent=1))
+
+    def _build_shared_pch(self, clangd_path: str, args: list[str]) -> Optional[str]:
+        # PCH format is specific to the exact compiler version - use clang from clangd's installation
+        clang_path = shutil.which("clang++", path=os.path.dirname(os.path.realpath(clangd_path)))
+        if not clang_path:
+            logger.warning(f"clang++ not found next to {clangd_path}, shared precompiled header will not be used")
+            return None
+
+        header_path = os.path.abspath(os.path.join(CLANGD_PROFILE_CACHE_PATH, "shared.hpp"))
+        pch_path = os.path.abspath(os.path.join(CLANGD_PROFILE_CACHE_PATH, "shared.hpp.pch"))
+        header = "".join(f"#include {header}\n" for header in self.shared_pch_headers)
+        # the PCH is rebuilt when headers change - including change of flags
+        header = f"// {json.dumps(args)}\n{header}"
+        if not write_file_if_changed(header_path, header) and os.path.exists(pch_path):
+            return pch_path
+
+        logger.info(f"building shared precompiled header with {clang_path}")
+        result = subprocess.run([clang_path, *args, "-x", "c++-header", header_path, "-o", pch_path],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            logger.warning(f"failed to build shared precompiled header:\n{result.stdout.decode()}")
+            if os.path.exists(pch_path):
+                os.remove(pch_path)
+            return None
+        return pch_path
+
+# return whether the file has been written
+def write_file_if_changed(path: str, content: str) -> bool:
+    try:
+        if read_file(path) == content:
+            return False
+    except FileNotFoundError:
+        pass
+
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
+    return True
+
+# seconds to wait for clangd to exit after the exit notification
+CLANGD_EXIT_TIMEOUT = 5
+
+# seconds to wait for clangd --version
+CLANGD_VERSION_TIMEOUT = 10
+
+# maximum number of bytes taken from clangd's stdout at once
+RECEIVE_CHUNK_SIZE = 1 << 16
+
+# https://www.jsonrpc.org/specification#error_object
+JSON_RPC_ERROR_METHOD_NOT_FOUND = -32601
+
+# Record mode: with CLANGD_RECORD=path, all messages of all connections are appended to the file
+# as JSON lines: {"connection": ..., "direction": "send" | "receive", "message": ...}.
+# Recordings can be replayed without clangd by benchmarks/fake_clangd.py.
+CLANGD_RECORD_ENV = "CLANGD_RECORD"
+
+class LspRecorder:
+    # shared by all connections (each has its own loop thread)
+    lock = threading.Lock()
+    connection_ids = count(1)
+
+    def __init__(self, path: str):
+        self.path = path
+        # pid because multiple processes (doit workers) may record to the same file
+        self.connection = f"{os.getpid()}-{next(LspRecorder.connection_ids)}"
+
+    def record(self, direction: str, message: dict[str, Any]) -> None:
+        line = json.dumps({"connection": self.connection, "direction": direction, "message": message},
+            indent=None, separators=(",", ":")) + "\n"
+        with LspRecorder.lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+def make_lsp_recorder() -> Optional[LspRecorder]:
+    path = os.environ.get(CLANGD_RECORD_ENV)
+    return LspRecorder(path) if path else None
+
+# Traffic statistics of 1 LSP method. Latency (time from sending a request to receiving its
+# response) is kept in a histogram with power of 2 buckets: bucket 0 counts latencies below
+# 1 microsecond, bucket i counts [2^(i-1), 2^i) microseconds.
+LATENCY_HISTOGRAM_BUCKETS = 32
+
+class MethodMetrics:
+    __slots__ = ("requests", "notifications_sent", "notifications_received", "bytes_sent", "bytes_received",
+        "latency_total", "latency_histogram")
+
+    def __init__(self):
+        self.requests = 0
+        self.notifications_sent = 0
+        self.notifications_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_total = 0.0 # seconds
+        self.latency_histogram = [0] * LATENCY_HISTOGRAM_BUCKETS
+
+    def add_latency(self, seconds: float) -> None:
+        self.latency_total += seconds
+        bucket = min(int(seconds * 1e6).bit_length(), LATENCY_HISTOGRAM_BUCKETS - 1)
+        self.latency_histogram[bucket] += 1
+
+    def merge(self, other: "MethodMetrics") -> None:
+        for name in MethodMetrics.__slots__:
+            if name != "latency_histogram":
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+        for bucket, count in enumerate(other.latency_histogram):
+            self.latency_histogram[bucket] += count
+
+    # upper bound (seconds) of the bucket that contains the given fraction of latencies
+    # (e.g. 0.5 for the median), None if there were no responses
+    def latency_quantile(self, fraction: float) -> Optional[float]:
+        responses = sum(self.latency_histogram)
+        if responses == 0:
+            return None
+        seen = 0
+        for bucket, count in enumerate(self.latency_histogram):
+            seen += count
+            if seen >= fraction * responses:
+                return (1 << bucket) / 1e6
+        return None
+
+# method name => statistics
+class LspMetrics:
+    def __init__(self):
+        self.methods: dict[str, MethodMetrics] = {}
+
+    def method(self, name: str) -> MethodMetrics:
+        metrics = self.methods.get(name)
+        if metrics is None:
+            metrics = self.methods[name] = MethodMetrics()
+        return metrics
+
+    def merge(self, other: "LspMetrics") -> None:
+        for name, metrics in list(other.methods.items()):
+            self.method(name).merge(metrics)
+
+    def copy(self) -> "LspMetrics":
+        result = LspMetrics()
+        result.merge(self)
+        return result
+
+    def summary(self) -> str:
+        lines = []
+        # most time consuming first
+        for name, metrics in sorted(self.methods.items(), key=lambda item: item[1].latency_total, reverse=True):
+            line = (f"{name}: {metrics.requests} requests, {metrics.notifications_sent} + {metrics.notifications_received} "
+                f"notifications (sent + received), {metrics.bytes_sent} B sent, {metrics.bytes_received} B received")
+            median = metrics.latency_quantile(0.5)
+            if median is not None:
+                line += (f", latency: total {metrics.latency_total * 1000:.1f} ms, "
+                    f"median < {median * 1000:g} ms, 99% < {metrics.latency_quantile(0.99) * 1000:g} ms")
+            lines.append(line)
+        return "\n".join(lines)
+
+# https://microsoft.github.io/language-server-protocol/specifications/lsp/3.17/specification/#textDocument_publishDiagnostics
+def log_diagnostics(message: dict[str, Any]) -> None:
+    params = message.get("params")
+    if params:
+        diagnostics = params.get("diagnostics", [])
+        if diagnostics:
+            logger.warning(f"diagnostics for {uri_to_relative_path(params.get('uri'))}")
+            for diagnostic in diagnostics:
+                logger.warning(json.dumps(diagnostic, indent=4))
+
 # Resources for implementing the pipe
 # https://stackoverflow.com/questions/375427/a-non-blocking-read-on-a-subprocess-pipe-in-python
 # https://github.com/python-lsp/python-lsp-server/blob/develop/test/test_language_server.py
 # https://github.com/python-lsp/python-lsp-server/blob/ff418805b1a4361959ab8d1b560117f50fc08856/pylsp/python_lsp.py#L150
 # https://github.com/yeger00/pylspclient/blob/master/pylspclient/json_rpc_endpoint.py
+# https://docs.python.org/3/library/asyncio-subprocess.html
+#
+# The connection owns an asyncio event loop running in a background thread. A reader task
+# parses incoming messages: responses resolve futures registered by request id (so any
+# number of requests can be in flight and responses may arrive in any order) and
+# notifications are passed to registered handlers.
+#
+# Coroutines (request, notify) are the native interface and can be used to run many queries
+# concurrently (see run). Remaining methods are a synchronous facade for code that is not
+# asynchronous - they are safe to call from any thread other than the loop's thread.
 class Connection:
-    def __init__(self, connect=True, initialize=True):
+    def __init__(self, connect=True, initialize=True, launch_args: Sequence[str] = ("--log=error",)):
         self.id = 1
-        self.p = None
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[threading.Thread] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        # why the reader has stopped - no responses will arrive since then
+        self.reader_error: Optional[Exception] = None
+        self.parser = LspFrameParser()
         self.initialized = False
+        self.pending_responses: dict[Union[str, int], asyncio.Future] = {}
+        # only modified in the loop thread; request id => (method, time sent)
+        self.metrics = LspMetrics()
+        self.requests_in_flight: dict[Union[str, int], tuple[str, float]] = {}
+        self.notification_handlers: dict[str, list[Callable[[dict[str, Any]], None]]] = {}
+        self.register_notification_handler("textDocument/publishDiagnostics", log_diagnostics)
         self.clangd_path = get_clangd_path()
+        self.launch_args = list(launch_args)
+        self.recorder = make_lsp_recorder()
         if connect:
             self.open_connection()
             if initialize:
                 self.initialize()
 
+    def register_notification_handler(self, method: str, handler: Callable[[dict[str, Any]], None]) -> None:
+        self.notification_handlers.setdefault(method, []).append(handler)
+
     def open_connection(self) -> None:
-        self.p = subprocess.Popen([self.clangd_path, "--log=error"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.loop = asyncio.new_event_loop()
+        # daemon: a connection that was never closed must not prevent the interpreter from exiting
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="clangd-connection", daemon=True)
+        self.loop_thread.start()
+        self.run(self._open_process())
+
+    async def _open_process(self) -> None:
+        self.parser = LspFrameParser()
+        self.reader_error = None
+        self.process = await asyncio.create_subprocess_exec(self.clangd_path, *self.launch_args,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self.reader_task = asyncio.ensure_future(self._read_messages())
+
+    # run a coroutine in the connection's loop and wait for its result
+    def run(self, coroutine: Any, timeout: Optional[float] = None) -> Any:
+        if self.loop is None or not self.loop_thread.is_alive():
+            coroutine.close()
+            raise RuntimeError("connection is not open")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None and self.reader_error is None
+
+    async def _send(self, message: dict[str, Any]) -> None:
+        if self.reader_error is not None:
+            raise RuntimeError(f"connection to clangd is broken: {str(self.reader_error)}")
+        if self.recorder is not None:
+            self.recorder.record("send", message)
+        data = lsp_make_message(message)
+        method = message.get("method")
+        if method is not None:
+            metrics = self.metrics.method(method)
+            metrics.bytes_sent += len(data)
+            if "id" in message:
+                metrics.requests += 1
+                self.requests_in_flight[message["id"]] = (method, time.perf_counter())
+            else:
+                metrics.notifications_sent += 1
+        self.process.stdin.write(data)
+        await self.process.stdin.drain()
 
-    def send(self, message: bytes) -> None:
-        bytes_written = self.p.stdin.write(message)
-        if bytes_written != len(message):
-            raise RuntimeError(f"Wrote only {bytes_written} of {len(message)} bytes when sending:\n{message.decode()}")
+    async def _receive(self) -> Optional[dict[str, Any]]:
+        while True:
+            message = self.parser.next_message()
+            if message is not None:
+                return message
+
+            # large messages are taken at once instead of in many small chunks
+            data = await self.process.stdout.read(max(RECEIVE_CHUNK_SIZE, self.parser.bytes_needed()))
+            if not data:
+                return None # EOF
+            self.parser.feed(data)
+
+    async def _read_messages(self) -> None:
+        try:
+            while True:
+                message = await self._receive()
+                if message is None:
+                    break
+                if self.recorder is not None:
+                    self.recorder.record("receive", message)
+
+                if json_rpc_is_notification(message):
+                    metrics = self.metrics.method(message.get("method"))
+                    metrics.notifications_received += 1
+                    metrics.bytes_received += self.parser.last_frame_size
+                    self._dispatch_notification(message)
+                elif "method" in message:
+                    # a request from the server - none are expected as no capabilities that use them are declared
+                    await self._send({
+                        "jsonrpc": "2.0",
+                        "id": message["id"],
+                        "error": {"code": JSON_RPC_ERROR_METHOD_NOT_FOUND, "message": f'unsupported method {message["method"]}'}
+                    })
+                else:
+                    self._resolve_response(message)
+            reason = RuntimeError("clangd has closed the connection")
+        except asyncio.CancelledError:
+            reason = RuntimeError("connection has been closed")
+        except Exception as err:
+            reason = err
+            logger.error(f"failed to read a message from clangd: {str(err)}")
+
+        # the stream can not be resynchronized - the process is of no use anymore
+        self.reader_error = reason
+        if self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+        for future in self.pending_responses.values():
+            if not future.done():
+                future.set_exception(reason)
+
+    def _dispatch_notification(self, message: dict[str, Any]) -> None:
+        if DEBUG:
+            logger.info(f"NOTIFICATION:\n{json.dumps(message, indent=4)}")
+        for handler in self.notification_handlers.get(message.get("method"), []):
+            try:
+                handler(message)
+            except Exception as err:
+                logger.error(f'handler for {message.get("method")} failed: {str(err)}')
+
+    def _resolve_response(self, message: dict[str, Any]) -> None:
+        id = message.get("id")
+        request = self.requests_in_flight.pop(id, None)
+        if request is not None:
+            method, time_sent = request
+            metrics = self.metrics.method(method)
+            metrics.add_latency(time.perf_counter() - time_sent)
+            metrics.bytes_received += self.parser.last_frame_size
+        future = self.pending_responses.get(id)
+        if future is None or future.done():
+            return # discarded
+
+        if json_rpc_is_error(message):
+            future.set_exception(RuntimeError(f"JSON RPC error:\n{json.dumps(json_rpc_response_extract_error(message), indent=4)}"))
+        else:
+            try:
+                future.set_result(json_rpc_response_extract_result(message, id))
+            except RuntimeError as err:
+                future.set_exception(err)
 
-        self.p.stdin.flush()
+    async def _send_request(self, method: str, params: Any) -> Union[str, int]:
+        # ids are only generated within the loop thread - no synchronization needed
+        id = self.id
+        self.id += 1
+        self.pending_responses[id] = self.loop.create_future()
+        await self._send(json_rpc_make_request(id, method, params))
+        return id
 
-    def receive(self) -> str:
-        headers = []
+    async def _wait_for_response(self, id: Union[str, int]) -> Any:
+        future = self.pending_responses.get(id)
+        if future is None:
+            raise RuntimeError(f"no request with id {id} is in flight")
+        try:
+            return await future
+        finally:
+            self.pending_responses.pop(id, None)
 
-        while True:
-            line = self.p.stdout.readline()
-            if line == b"\r\n":
-                break
-            else:
-                headers.append(line)
+    async def request(self, method: str, params: Any) -> Any:
+        return await self._wait_for_response(await self._send_request(method, params))
 
-        length = 0
-        for hdr in headers:
-            hdr = hdr.decode()
-            if HEADER_CONTENT_LENGTH in hdr:
-                length = int(hdr.removeprefix(HEADER_CONTENT_LENGTH))
-                break
+    async def notify(self, method: str, params: Any) -> None:
+        await self._send(json_rpc_make_notification(method, params))
 
-        if length == 0:
-            raise RuntimeError(f'invalid or missing "{HEADER_CONTENT_LENGTH}" header')
+    async def _request_all(self, requests: Sequence[tuple[str, Any]]) -> list[Any]:
+        return await asyncio.gather(*(self.request(method, params) for method, params in requests))
 
-        return self.p.stdout.read(length).decode()
+    # snapshot of traffic statistics (safe to call from any thread)
+    def lsp_metrics(self) -> LspMetrics:
+        return self.metrics.copy()
 
     def make_lsp_notification(self, method: str, params: Any) -> None:
-        self.send(lsp_make_message(json_rpc_make_notification(method, params)))
-
-    def receive_response(self, id: Union[str, int]) -> Any:
-        while True:
-            message = json.loads(self.receive())
-            if json_rpc_is_error(message):
-                raise RuntimeError(f"JSON RPC error:\n{json.dumps(json_rpc_response_extract_error(message), indent=4)}")
-            elif json_rpc_is_notification(message):
-                if DEBUG:
-                    logger.info(f"NOTIFICATION:\n{json.dumps(message, indent=4)}")
-                if message.get("method") == "textDocument/publishDiagnostics":
-                    params = message.get("params")
-                    if params:
-                        diagnostics = params.get("diagnostics", [])
-                        if diagnostics:
-                            logger.warning(f"diagnostics for {uri_to_relative_path(params.get('uri'))}")
-                            for diagnostic in diagnostics:
-                                logger.warning(json.dumps(diagnostic, indent=4))
-            else:
-               return json_rpc_response_extract_result(message, id)
+        self.run(self.notify(method, params))
 
     def make_lsp_request(self, method: str, params: Any) -> Any:
-        id = self.id
-        self.send(lsp_make_message(json_rpc_make_request(id, method, params)))
-        self.id += 1
-        return self.receive_response(id)
+        return self.run(self.request(method, params))
+
+    # all requests are in flight at the same time, results are returned in the same order
+    def make_lsp_requests(self, requests: Sequence[tuple[str, Any]]) -> list[Any]:
+        return self.run(self._request_all(requests))
 
     def initialize(self) -> Any:
-        if not self.p:
+        if not self.process:
             raise RuntimeError("initialization requires opened connection")
 
         result = self.make_lsp_request("initialize", {
@@ -259,92 +738,206 @@ class Connection:
 
         self.initialized = False
 
+    async def _exit_process(self) -> None:
+        await self.notify("exit", None)
+        try:
+            await asyncio.wait_for(self.process.wait(), CLANGD_EXIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"clangd (pid {self.process.pid}) did not exit in {CLANGD_EXIT_TIMEOUT}s, killing it")
+            await self._kill_process()
+
+    async def _kill_process(self) -> None:
+        if self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+        await self.process.wait()
+
+    async def _stop_reader(self) -> None:
+        if self.reader_task:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+
     def close_connection(self) -> None:
-        self.shutdown()
-        if self.p:
-            self.make_lsp_notification("exit", None)
-            self.p = None
+        if self.loop is None:
+            return
+
+        # the loop thread is gone (interpreter shutdown) or it is the caller (garbage
+        # collection in the loop thread) - nothing can be awaited, the process is left to the OS
+        if not self.loop_thread.is_alive() or threading.current_thread() is self.loop_thread:
+            return
+
+        try:
+            if self.is_alive():
+                self.shutdown()
+                self.run(self._exit_process())
+            elif self.process is not None:
+                # the reader has failed - the process has been killed, reap it
+                self.run(self._kill_process(), CLANGD_EXIT_TIMEOUT)
+            self.run(self._stop_reader())
+        finally:
+            self.initialized = False
+            self.process = None
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
+            self.loop_thread = None
 
     def __del__(self):
         self.close_connection()
 
+# Semantic tokens of a file are stored as a struct of arrays - 1 compact array per attribute
+# instead of 1 Python object per token (large files have tens of thousands of tokens).
+# Tokens are sorted by position, as reported by the server.
+class SemanticTokens:
+    def __init__(self, line: Sequence[int] = (), column: Sequence[int] = (), length: Sequence[int] = (),
+        token_type: Sequence[int] = (), token_modifiers: Sequence[int] = (),
+        color_variant: Optional[Sequence[int]] = None, last_reference: Optional[Sequence[int]] = None):
+        self.line = array("I", line)
+        self.column = array("I", column)
+        self.length = array("I", length)
+        self.token_type = array("I", token_type)
+        self.token_modifiers = array("I", token_modifiers)
+        size = len(self.line)
+        # 0 = no variance
+        self.color_variant = array("I", color_variant) if color_variant is not None else array("I", bytes(4 * size))
+        self.last_reference = array("B", last_reference) if last_reference is not None else array("B", bytes(size))
+        self._position_keys: Optional[array] = None
+
+    def __len__(self) -> int:
+        return len(self.line)
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return [SemanticToken(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("semantic token index out of range")
+        return SemanticToken(self, index)
+
+    def __iter__(self) -> Iterator["SemanticToken"]:
+        for i in range(len(self)):
+            yield SemanticToken(self, i)
+
+    def position(self, index: int) -> tuple[int, int]:
+        return self.line[index], self.column[index]
+
+    # sorted position_key of each token, built on first use (not needed on cache hits)
+    # bisect on it compares plain integers instead of (line, column) tuples
+    def position_keys(self) -> array:
+        if self._position_keys is None:
+            self._position_keys = array("q", [position_key(line, column) for line, column in zip(self.line, self.column)])
+        return self._position_keys
+
+# light view of 1 token in SemanticTokens, for code that needs per-token access
 class SemanticToken:
-    def __init__(self, line: int, column: int, length: int, token_type: int, token_modifiers: int):
-        self.line = line
-        self.column = column
-        self.length = length
-        self.token_type = token_type
-        self.token_modifiers = token_modifiers
-        self.color_variant = 0 # (no variance)
-        self.last_reference = False
+    __slots__ = ("tokens", "index")
+
+    def __init__(self, tokens: SemanticTokens, index: int):
+        self.tokens = tokens
+        self.index = index
+
+    @property
+    def line(self) -> int:
+        return self.tokens.line[self.index]
+
+    @property
+    def column(self) -> int:
+        return self.tokens.column[self.index]
+
+    @property
+    def length(self) -> int:
+        return self.tokens.length[self.index]
+
+    @property
+    def token_type(self) -> int:
+        return self.tokens.token_type[self.index]
+
+    @property
+    def token_modifiers(self) -> int:
+        return self.tokens.token_modifiers[self.index]
+
+    @property
+    def color_variant(self) -> int:
+        return self.tokens.color_variant[self.index]
+
+    @color_variant.setter
+    def color_variant(self, value: int) -> None:
+        self.tokens.color_variant[self.index] = value
+
+    @property
+    def last_reference(self) -> bool:
+        return bool(self.tokens.last_reference[self.index])
+
+    @last_reference.setter
+    def last_reference(self, value: bool) -> None:
+        self.tokens.last_reference[self.index] = int(value)
+
+    def _key(self) -> tuple[int, int, int]:
+        return self.line, self.column, self.length
 
     def __eq__(self, other) -> bool:
-        return self.line == other.line and self.column == other.column and self.length == other.length
+        return self._key() == other._key()
 
     def __ne__(self, other) -> bool:
         return not self.__eq__(other)
 
     def __lt__(self, other) -> bool:
-        return (self.line, self.column, self.length) < (other.line, other.column, other.length)
+        return self._key() < other._key()
 
     def __le__(self, other) -> bool:
-        return (self.line, self.column, self.length) <= (other.line, other.column, other.length)
+        return self._key() <= other._key()
 
     def __gt__(self, other) -> bool:
-        return (self.line, self.column, self.length) > (other.line, other.column, other.length)
+        return self._key() > other._key()
 
     def __ge__(self, other) -> bool:
-        return (self.line, self.column, self.length) >= (other.line, other.column, other.length)
+        return self._key() >= other._key()
 
-# bisect_left supports custom comparison in Python 3.10, in 3.9 there is a workaround:
-# https://stackoverflow.com/questions/27672494/how-to-use-bisect-insort-left-with-a-key
-class KeyWrapper:
-    def __init__(self, iterable: Sequence, key: Callable):
-        self.iterable = iterable
-        self.key = key
+# positions packed into 1 integer that orders the same way as (line, column)
+# (LSP positions are unsigned 32-bit integers)
+def position_key(line: int, column: int) -> int:
+    return (line << 32) | column
 
-    def __getitem__(self, i: int):
-        return self.key(self.iterable[i])
-
-    def __len__(self) -> int:
-        return len(self.iterable)
+# token column is relative to the previous token only when both are on the same line
+def _accumulate_column(column: int, deltas: tuple[int, int]) -> int:
+    delta_line, delta_column = deltas
+    return column + delta_column if delta_line == 0 else delta_column
 
 # https://microsoft.github.io/language-server-protocol/specifications/lsp/3.17/specification/#textDocument_semanticTokens
 # the data is packed in an array of integers, where each 5 consecutive integers denote specific attributes
-def parse_semantic_token_data(data: list[int]) -> list[SemanticToken]:
-    result = []
-
-    last_line = 0
-    last_column = 0
-
-    for i in range(0, len(data) // 5):
-        idx = i * 5
-        delta_line = data[idx]
-        delta_column = data[idx + 1]
-        length = data[idx + 2]
-        token_type = data[idx + 3]
-        token_modifiers = data[idx + 4]
-
-        # token column is only relative when on the same line
-        if delta_line != 0:
-            last_column = 0
-
-        line = last_line + delta_line
-        column = last_column + delta_column
-
-        result.append(SemanticToken(line, column, length, token_type, token_modifiers))
-
-        last_line = line
-        last_column = column
-
-    return result
+# (strided slices split it into attribute columns, positions are decoded with running sums)
+def parse_semantic_token_data(data: list[int]) -> SemanticTokens:
+    size = len(data) // 5 * 5
+    delta_line = data[0:size:5]
+    delta_column = data[1:size:5]
+    columns = accumulate(zip(delta_line, delta_column), _accumulate_column, initial=0)
+    next(columns) # skip initial
+    return SemanticTokens(
+        accumulate(delta_line),
+        columns,
+        data[2:size:5],
+        data[3:size:5],
+        data[4:size:5])
 
 # Highlights are defined by DocumentHighlight type, which has a Range member.
 # Ranges can be multiline. In clangd, a highlight can match multiple semantic
 # tokens because these can not be multiline and clangd reports spliced code
 # as multiple tokens.
 # For this reason this function returns a list, not Optional[SemanticToken]
-def document_highlight_find_matching_tokens(highlight: dict[str, Any], semantic_tokens: list[SemanticToken]) -> list[SemanticToken]:
+def document_highlight_find_matching_tokens(highlight: dict[str, Any], semantic_tokens: SemanticTokens) -> list[SemanticToken]:
+    l, r = document_highlight_find_matching_token_indexes(highlight, semantic_tokens)
+    return semantic_tokens[l:r]
+
+# same as above, returns [first, last) indexes
+def document_highlight_find_matching_token_indexes(highlight: dict[str, Any], semantic_tokens: SemanticTokens) -> tuple[int, int]:
     range = highlight["range"]
     start = range["start"]
     end = range["end"]
@@ -353,10 +946,17 @@ def document_highlight_find_matching_tokens(highlight: dict[str, Any], semantic_
     end_line = end["line"]
     end_column = end["character"]
 
-    key = lambda token: (token.line, token.column)
-    l = bisect_left(KeyWrapper(semantic_tokens, key), (start_line, start_column))
-    r = bisect_right(KeyWrapper(semantic_tokens, key), (end_line, end_column))
-    return semantic_tokens[l:r]
+    keys = semantic_tokens.position_keys()
+    l = bisect_left(keys, position_key(start_line, start_column))
+    r = bisect_right(keys, position_key(end_line, end_column), l)
+    return l, r
+
+# note: assumes that token columns (UTF-16 code units in LSP) match string indexes
+def token_text(lines: list[str], token: SemanticToken) -> str:
+    return lines[token.line][token.column:token.column+token.length]
+
+# https://en.cppreference.com/w/cpp/language/identifiers (without non-ASCII characters)
+IDENTIFIER_REGEX = re.compile(r"[A-Za-z_][A-Za-z_0-9]*")
 
 # https://stackoverflow.com/questions/67680296/syntaxerror-f-string-expression-part-cannot-include-a-backslash
 def list_of_strings_to_pretty_str(l: list[str]) -> str:
@@ -367,16 +967,27 @@ def list_of_strings_to_pretty_str(l: list[str]) -> str:
         return "[]"
 
 class Clangd:
-    def __init__(self, connect=True, initialize=True):
-        self.conn = Connection(connect, False)
+    def __init__(self, connect=True, initialize=True, profile: Optional[ClangdLaunchProfile] = None):
+        self.profile = profile or ClangdLaunchProfile()
+        self.conn = Connection(connect, False, self.profile.launch_args())
+        # textDocument/documentHighlight requests made and avoided by apply_color_variance
+        self.highlight_requests_sent = 0
+        self.highlight_requests_avoided = 0
         if initialize:
             self.initialize()
 
+    def is_alive(self) -> bool:
+        return self.conn.is_alive()
+
+    def close(self) -> None:
+        self.conn.close_connection()
+
     def initialize(self):
         result = self.conn.initialize()
         if DEBUG:
             logger.info(json.dumps(result, indent=4))
-        logger.info(f'Using clangd version: {result["serverInfo"]["version"]}')
+        self.server_version: str = result["serverInfo"]["version"]
+        logger.info(f'Using clangd version: {self.server_version}')
         self._parse_capabilities(result["capabilities"])
         logger.info("Successful initialization")
 
@@ -406,9 +1017,10 @@ class Clangd:
         # TODO this triggers a notification textDocument/publishDiagnostics
         # which can be later used to verify that the code is correct
         text = read_file(path)
-        self.conn.make_lsp_notification("textDocument/didOpen", {
-            "textDocument": lsp_make_text_document_item(path, text)
-        })
+        with span("clangd open", file=path):
+            self.conn.make_lsp_notification("textDocument/didOpen", {
+                "textDocument": lsp_make_text_document_item(path, text)
+            })
         return text
 
     def text_document_close(self, path: str) -> None:
@@ -454,56 +1066,144 @@ class Clangd:
             "range": range
         })
 
+    def semantic_tokens(self, path: str) -> SemanticTokens:
+        with span("semantic tokens request", file=path):
+            result = self.text_document_semantic_tokens_full(path)
+        with span("semantic tokens parse", file=path):
+            return parse_semantic_token_data(result["data"])
+
     def file_content_and_semantic_tokens(self, path: str):
         file_content = self.text_document_open(path)
-        semantic_tokens = parse_semantic_token_data(self.text_document_semantic_tokens_full(path)["data"])
+        semantic_tokens = self.semantic_tokens(path)
         self.text_document_close(path)
         return file_content, semantic_tokens
 
     def file_content_and_semantic_tokens_with_color_variance(self, path: str):
         file_content = self.text_document_open(path)
-        semantic_tokens = parse_semantic_token_data(self.text_document_semantic_tokens_full(path)["data"])
-
-        # The goal:
-        # - for each token that has a type eligible for color variance:
-        #   - find its usages (highlights)
-        #   - for each highlight:
-        #     - apply the same color variant ID
-        #     - mark the last usage (this will inform ACH that after this token the ID can be recycled)
-        #   - change ID for the next token
-        #
-        # complexity: O(n) where n is len(semantic_tokens)
-        # explanation:
-        # - each token is visited at most once
-        # - the more highlights a given token has the more later tokens will be skipped
+        semantic_tokens = self.semantic_tokens(path)
+        with span("color variance", file=path):
+            self.apply_color_variance(path, file_content, semantic_tokens)
+        self.text_document_close(path)
+        return file_content, semantic_tokens
+
+    # The goal:
+    # - for each token that has a type eligible for color variance:
+    #   - find its usages (highlights)
+    #   - for each highlight:
+    #     - apply the same color variant ID
+    #     - mark the last usage (this will inform ACH that after this token the ID can be recycled)
+    #   - change ID for the next token
+    #
+    # complexity: O(n) where n is len(semantic_tokens)
+    # explanation:
+    # - each token is visited at most once
+    # - the more highlights a given token has the more later tokens will be skipped
+    #
+    # There is no LSP request that reports all references of all symbols at once
+    # (textDocument/ast does not identify symbols, see text_document_ast) so the usages are
+    # still obtained with textDocument/documentHighlight, but not 1 round trip per symbol:
+    # - Usages are queried in rounds. Each round queries (all requests at once) 1 token
+    #   per distinct identifier name that is not yet covered by results of earlier queries.
+    #   Usually 1 round is enough - more are needed only when different symbols share a name
+    #   (e.g. same variable name in different functions), 1 more round per such symbol.
+    # - After all groups of usages (symbols) are known, color variants are assigned in
+    #   the same order as if tokens were queried one by one.
+    # This bounds the number of round trips, not the number of requests - there is still
+    # 1 request per symbol (except names resolved locally, see below).
+    #
+    # Names which appear only once in the whole file can only be highlighted in that 1 place.
+    # Usages of such tokens are determined locally, without asking clangd. This differs from
+    # querying them only if clangd would not report the token itself (empty highlights, e.g.
+    # for a name it can not resolve): such a token used to keep variant 0, now it gets its own
+    # variant and is marked as the last reference. Variants of all other tokens are the same.
+    def apply_color_variance(self, path: str, file_content: str, semantic_tokens: SemanticTokens) -> None:
+        lines = file_content.splitlines()
+        token_lines = semantic_tokens.line
+        token_columns = semantic_tokens.column
+        token_lengths = semantic_tokens.length
+        variant_types = set(self.semantic_token_type_indexes_for_color_variants)
+        candidates = [i for i, token_type in enumerate(semantic_tokens.token_type) if token_type in variant_types]
+        names = {i: lines[token_lines[i]][token_columns[i]:token_columns[i] + token_lengths[i]] for i in candidates}
+        # counted in the whole text (not only in tokens) so that occurrences which are
+        # not reported as tokens (e.g. in comments or macro bodies) prevent local resolution
+        name_occurrences = Counter(IDENTIFIER_REGEX.findall(file_content))
+
+        # queried token index => for each of its highlights: [first, last) indexes of matching tokens
+        usages: dict[int, list[tuple[int, int]]] = {}
+        # token index => index of the queried token whose usages include this token
+        covered_by: dict[int, int] = {}
+
+        for i in candidates:
+            if name_occurrences[names[i]] == 1:
+                line, column = semantic_tokens.position(i)
+                highlight = {"range": lsp_make_range(line, column, line, column + token_lengths[i])}
+                usages[i] = [document_highlight_find_matching_token_indexes(highlight, semantic_tokens)]
+                covered_by[i] = i
+                self.highlight_requests_avoided += 1
+
+        remaining = candidates
+        while remaining:
+            queried: dict[str, int] = {}
+            next_remaining = []
+            for i in remaining:
+                if i in covered_by:
+                    continue
+                if names[i] in queried:
+                    next_remaining.append(i)
+                else:
+                    queried[names[i]] = i
+
+            if not queried:
+                break
+
+            self.highlight_requests_sent += len(queried)
+            with span("documentHighlight round", file=path, requests=len(queried)):
+                results = self.conn.make_lsp_requests([
+                    ("textDocument/documentHighlight", lsp_make_text_document_position_params(path,
+                        lsp_make_position(token_lines[i], token_columns[i])))
+                    for i in queried.values()])
+
+            for i, highlights in zip(queried.values(), results):
+                usages[i] = self._highlights_to_token_indexes(path, lines, highlights, semantic_tokens)
+                for l, r in usages[i]:
+                    for j in range(l, r):
+                        covered_by.setdefault(j, i)
+
+            remaining = next_remaining
+
+        color_variants = semantic_tokens.color_variant
+        last_references = semantic_tokens.last_reference
         color_variant = 1
-        for token in semantic_tokens:
+        for i in candidates:
             # skip tokens that have color variant already applied
-            if token.color_variant != 0:
-                continue
-            # do not variant-color tokens of uninteresting types
-            if not token.token_type in self.semantic_token_type_indexes_for_color_variants:
+            if color_variants[i] != 0:
                 continue
 
-            highlights = self.text_document_document_highlight(path, lsp_make_position(token.line, token.column))
-            for idx, hl in enumerate(highlights):
-                matching_tokens = document_highlight_find_matching_tokens(hl, semantic_tokens)
-                if not matching_tokens:
-                    raise RuntimeError(
-                        f"failed to apply color variance to semantic tokens for file: {path}\n"
-                        f"reason: failed to find matching semantic token(s) for this highlight:\n{json.dumps(hl, indent=4)}\n"
-                        f"semantic tokens for this file (with color variance modifications so far):\n"
-                        f"{self.semantic_tokens_debug_info(semantic_tokens, file_content.splitlines())}")
-
-                for mt in matching_tokens:
-                    mt.color_variant = color_variant
+            # a token that was not queried has the same usages as the token that covered it
+            highlights = usages.get(i)
+            if highlights is None:
+                highlights = usages[covered_by[i]]
+            for idx, (l, r) in enumerate(highlights):
+                for j in range(l, r):
+                    color_variants[j] = color_variant
                     if idx + 1 == len(highlights):
-                        mt.last_reference = True
+                        last_references[j] = 1
 
             color_variant += 1
 
-        self.text_document_close(path)
-        return file_content, semantic_tokens
+    def _highlights_to_token_indexes(self, path: str, lines: list[str], highlights: list[dict[str, Any]],
+        semantic_tokens: SemanticTokens) -> list[tuple[int, int]]:
+        result = []
+        for hl in highlights:
+            l, r = document_highlight_find_matching_token_indexes(hl, semantic_tokens)
+            if l == r:
+                raise RuntimeError(
+                    f"failed to apply color variance to semantic tokens for file: {path}\n"
+                    f"reason: failed to find matching semantic token(s) for this highlight:\n{json.dumps(hl, indent=4)}\n"
+                    f"semantic tokens for this file (before color variance):\n"
+                    f"{self.semantic_tokens_debug_info(semantic_tokens, lines)}")
+            result.append((l, r))
+        return result
 
     def list_of_token_modifiers(self, token_modifiers: int) -> list[str]:
         result = []
@@ -512,10 +1212,10 @@ class Clangd:
                 result.append(self.semantic_token_modifiers[i])
         return result
 
-    def semantic_tokens_debug_info(self, semantic_tokens: list[SemanticToken], lines: list[str]) -> str:
+    def semantic_tokens_debug_info(self, semantic_tokens: SemanticTokens, lines: list[str]) -> str:
         output_lines = []
         for token in semantic_tokens:
-            token_string = lines[token.line][token.column:token.column+token.length]
+            token_string = token_text(lines, token)
             output_lines.append(
                 # add 1 to line and column to change 0-based index to 1-based for human output
                 f'line|col+len|cv: {token.line+1:>3}|{token.column+1:>3}+{token.length:>2}|{token.color_variant:>2}, '
@@ -525,11 +1225,266 @@ class Clangd:
             )
         return "".join(output_lines)
 
+# Multiple clangd processes, each used by at most 1 thread at a time. Instances are started
+# lazily (up to size) so a serial caller will only ever use 1 process. Work is spread across
+# processes by map_files - clangd communication is I/O so threads are sufficient to
+# saturate all processes (their Python-side work is small compared to clangd's work).
+class ClangdPool:
+    def __init__(self, size: Optional[int] = None, profile: Optional[ClangdLaunchProfile] = None):
+        self.size = max(1, size or os.cpu_count() or 1)
+        self.profile = profile or ClangdLaunchProfile()
+        self.profile.prepare(get_clangd_path())
+        self.lock = threading.Lock()
+        self.instances: list[Clangd] = []
+        # number of instances being started
+        self.spawning = 0
+        # statistics of instances that are no longer in the pool
+        self.highlight_requests_sent = 0
+        self.highlight_requests_avoided = 0
+        self.metrics = LspMetrics()
+        self.instances_closed = 0
+        self.instances_discarded = 0
+        # LIFO: a serial caller keeps using the same (warm) instance
+        self.idle: queue.LifoQueue[Clangd] = queue.LifoQueue()
+        # 1 instance is started immediately - the server information is needed upfront
+        reference = self._spawn()
+        self.server_version = reference.server_version
+        self.semantic_token_types = reference.semantic_token_types
+        self.semantic_token_modifiers = reference.semantic_token_modifiers
+        self.idle.put(reference)
+
+    # reserved: the slot has already been counted in self.spawning (see _reserve)
+    def _spawn(self, reserved: bool = False) -> Clangd:
+        try:
+            with span("clangd start"):
+                clangd = Clangd(profile=self.profile)
+        except BaseException:
+            if reserved:
+                with self.lock:
+                    self.spawning -= 1
+            raise
+        with self.lock:
+            self.instances.append(clangd)
+            if reserved:
+                self.spawning -= 1
+        return clangd
+
+    # requires lock; instances being started count towards the size so that concurrent
+    # callers can not start more processes than the pool allows
+    def _reserve(self) -> bool:
+        if len(self.instances) + self.spawning >= self.size:
+            return False
+        self.spawning += 1
+        return True
+
+    # requires lock
+    def _keep_statistics(self, clangd: Clangd) -> None:
+        self.highlight_requests_sent += clangd.highlight_requests_sent
+        self.highlight_requests_avoided += clangd.highlight_requests_avoided
+        self.metrics.merge(clangd.conn.lsp_metrics())
+        self.instances_closed += 1
+
+    # reserve: keep the slot of the discarded instance for its replacement
+    def _discard(self, clangd: Clangd, reserve: bool = False) -> None:
+        with self.lock:
+            if reserve:
+                self.spawning += 1
+            if clangd not in self.instances:
+                return
+            self.instances.remove(clangd)
+        try:
+            clangd.close()
+        except Exception as err:
+            logger.warning(f"failed to close clangd instance: {str(err)}")
+        with self.lock:
+            self._keep_statistics(clangd)
+            self.instances_discarded += 1
+
+    def acquire(self) -> Clangd:
+        try:
+            clangd = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                reserved = self._reserve()
+            clangd = self._spawn(reserved=True) if reserved else self.idle.get()
+
+        # health check: a crashed process is replaced by a new one
+        if not clangd.is_alive():
+            logger.warning("clangd instance is no longer running, starting a new one")
+            self._discard(clangd, reserve=True)
+            clangd = self._spawn(reserved=True)
+        return clangd
+
+    def release(self, clangd: Clangd) -> None:
+        self.idle.put(clangd)
+
+    @contextmanager
+    def session(self) -> Iterator[Clangd]:
+        clangd = self.acquire()
+        try:
+            yield clangd
+        except Exception:
+            # the connection may be left in an unknown state (e.g. unread responses)
+            self._discard(clangd)
+            raise
+        else:
+            self.release(clangd)
+
+    def file_content_and_semantic_tokens_with_color_variance(self, path: str):
+        with self.session() as clangd:
+            return clangd.file_content_and_semantic_tokens_with_color_variance(path)
+
+    # process many files in parallel, results are returned in the same order as paths
+    # function is called with each path and should return the per-file result
+    def map_files(self, paths: Sequence[str], function: Optional[Callable[[str], Any]] = None) -> list[Any]:
+        if function is None:
+            function = self.file_content_and_semantic_tokens_with_color_variance
+        with ThreadPoolExecutor(max_workers=min(self.size, max(1, len(paths)))) as executor:
+            return list(executor.map(function, paths))
+
+    def highlight_request_statistics(self) -> tuple[int, int]:
+        with self.lock:
+            return (self.highlight_requests_sent + sum(clangd.highlight_requests_sent for clangd in self.instances),
+                self.highlight_requests_avoided + sum(clangd.highlight_requests_avoided for clangd in self.instances))
+
+    # LSP traffic of all instances, including ones that are no longer running
+    def lsp_metrics(self) -> LspMetrics:
+        with self.lock:
+            result = self.metrics.copy()
+            for clangd in self.instances:
+                result.merge(clangd.conn.lsp_metrics())
+        return result
+
+    def shutdown(self) -> None:
+        with self.lock:
+            instances = list(self.instances)
+            self.instances.clear()
+        if not instances:
+            return # already shut down
+
+        for clangd in instances:
+            try:
+                clangd.close()
+            except Exception as err:
+                logger.warning(f"failed to close clangd instance: {str(err)}")
+        with self.lock:
+            for clangd in instances:
+                self._keep_statistics(clangd)
+            # all instances ever started, their statistics are summed below
+            closed, discarded = self.instances_closed, self.instances_discarded
+
+        sent, avoided = self.highlight_request_statistics()
+        if sent or avoided:
+            logger.info(f"textDocument/documentHighlight requests: {sent} sent, {avoided} avoided by resolving unique names locally")
+        logger.info(f"LSP traffic of {closed} clangd instance(s) ({discarded} discarded after a crash or "
+            f"error):\n{self.lsp_metrics().summary()}")
+
+    def __del__(self):
+        self.shutdown()
+
+# Semantic tokens (with color variance applied) depend only on the file content and the
+# server: the clangd binary, the flags it was launched with and its configuration file.
+# Content-addressed cache entries are stored as flat arrays of integers, similarly to the
+# LSP token data.
+SEMANTIC_TOKEN_CACHE_FIELDS = 7
+# compile flags for all snippets, read by clangd from the working directory
+CLANGD_CONFIG_PATH = ".clangd"
+
+def _semantic_token_columns(semantic_tokens: SemanticTokens) -> tuple[array, ...]:
+    return (semantic_tokens.line, semantic_tokens.column, semantic_tokens.length, semantic_tokens.token_type,
+        semantic_tokens.token_modifiers, semantic_tokens.color_variant, semantic_tokens.last_reference)
+
+def semantic_tokens_to_json(semantic_tokens: SemanticTokens) -> str:
+    # interleave columns back into rows
+    data = [value for row in zip(*_semantic_token_columns(semantic_tokens)) for value in row]
+    return json.dumps(data, indent=None, separators=(",", ":"))
+
+def semantic_tokens_from_json(text: str) -> SemanticTokens:
+    data = json.loads(text)
+    size = len(data) // SEMANTIC_TOKEN_CACHE_FIELDS * SEMANTIC_TOKEN_CACHE_FIELDS
+    return SemanticTokens(*(data[field:size:SEMANTIC_TOKEN_CACHE_FIELDS] for field in range(SEMANTIC_TOKEN_CACHE_FIELDS)))
+
+# identifies the binary (version and build) without starting a server - much faster than
+# launching and initializing clangd
+@lru_cache(maxsize=None)
+def clangd_version_output(clangd_path: str) -> str:
+    # stdin is closed so that a server which ignores --version (e.g. a replay server)
+    # sees EOF instead of waiting for LSP messages from the terminal
+    try:
+        result = subprocess.run([clangd_path, "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, timeout=CLANGD_VERSION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"{clangd_path} --version did not finish in {CLANGD_VERSION_TIMEOUT}s")
+    if result.returncode != 0:
+        raise RuntimeError(f"{clangd_path} --version failed:\n{result.stdout.decode(errors='replace')}")
+    return result.stdout.decode(errors="replace")
+
+def clangd_server_key(clangd_path: str, profile: ClangdLaunchProfile) -> str:
+    try:
+        config = read_file(CLANGD_CONFIG_PATH)
+    except FileNotFoundError:
+        config = ""
+    return hash_strings(clangd_version_output(clangd_path), profile.description(), config)
+
+# Can be created and queried without a running server - clangd is started (through
+# the given function) only on a cache miss. The token legend of the server is stored
+# alongside the tokens, so that highlighting cached tokens does not need clangd either.
+class SemanticTokensCache:
+    def __init__(self, profile: ClangdLaunchProfile):
+        self.storage = DiskCache("clangd_semantic_tokens", "json")
+        # everything except file content that affects the result, computed once per build
+        self.server_key = clangd_server_key(get_clangd_path(), profile)
+
+    def key(self, file_content: str) -> str:
+        return hash_strings(self.server_key, file_content)
+
+    def get(self, file_content: str) -> Optional[SemanticTokens]:
+        text = self.storage.get(self.key(file_content))
+        if text is None:
+            return None
+        return semantic_tokens_from_json(text)
+
+    def put(self, file_content: str, semantic_tokens: SemanticTokens) -> None:
+        self.storage.put(self.key(file_content), semantic_tokens_to_json(semantic_tokens))
+
+    # (token types, token modifiers) of the server, None if it has never been started
+    def legend(self) -> Optional[tuple[list[str], list[str]]]:
+        text = self.storage.get(hash_strings(self.server_key, "legend"))
+        if text is None:
+            return None
+        legend = json.loads(text)
+        return legend["tokenTypes"], legend["tokenModifiers"]
+
+    def put_legend(self, semantic_token_types: list[str], semantic_token_modifiers: list[str]) -> None:
+        if self.legend() != (semantic_token_types, semantic_token_modifiers):
+            self.storage.put(hash_strings(self.server_key, "legend"),
+                json.dumps({"tokenTypes": semantic_token_types, "tokenModifiers": semantic_token_modifiers}))
+
+    # get_clangd is called only on a cache miss and may return None if clangd could not be started
+    def file_content_and_semantic_tokens_with_color_variance(self, get_clangd: Callable[[], Optional[ClangdPool]], path: str):
+        file_content = read_file(path)
+        semantic_tokens = self.get(file_content)
+        if semantic_tokens is not None:
+            return file_content, semantic_tokens
+
+        clangd = get_clangd()
+        if clangd is None:
+            raise RuntimeError("clangd is not running (see errors reported when it was started)")
+        file_content, semantic_tokens = clangd.file_content_and_semantic_tokens_with_color_variance(path)
+        self.put(file_content, semantic_tokens)
+        return file_content, semantic_tokens
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("specify 1 path (absolute or relative) to read")
+    if len(sys.argv) < 2:
+        print("specify 1 or more paths (absolute or relative) to read")
         exit()
 
-    clangd = Clangd()
-    file_content, semantic_tokens = clangd.file_content_and_semantic_tokens_with_color_variance(sys.argv[1])
-    print(clangd.semantic_tokens_debug_info(semantic_tokens, file_content.splitlines()))
+    pool = ClangdPool()
+    paths = sys.argv[1:]
+    results = pool.map_files(paths)
+    with pool.session() as clangd:
+        for path, (file_content, semantic_tokens) in zip(paths, results):
+            if len(paths) > 1:
+                print(path)
+            print(clangd.semantic_tokens_debug_info(semantic_tokens, file_content.splitlines()))
+    pool.shutdown()
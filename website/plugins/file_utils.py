@@ -1,4 +1,7 @@
 import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
 
 def is_relative_path(path: str) -> bool:
     return path[0] != "/"
@@ -18,6 +21,119 @@ def make_path_absolute(base_path: str, path: str) -> str:
         return path
 
 
+# (mtime_ns, size, inode) - if any changes, the file has changed
+FileStamp = Tuple[int, int, int]
+
+def file_stamp(stat: os.stat_result) -> FileStamp:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class FileCacheEntry:
+    __slots__ = ("stamp", "data", "text")
+
+    def __init__(self, stamp: FileStamp, data: bytes):
+        self.stamp = stamp
+        self.data = data
+        # decoded on first read as text
+        self.text: Optional[str] = None
+
+    def size(self) -> int:
+        # text is counted as 1 byte per character which is exact for ASCII
+        return len(self.data) * (1 if self.text is None else 2)
+
+
+class FileCache:
+    """
+    Process-wide cache of file contents, validated by stat on every read
+
+    The same files (code snippets, color files, data files) are read many times
+    during a build - by multiple directives and by clangd. An entry is returned only
+    if the file still has the same modification time, size and inode, so edits
+    are always picked up. Least recently used entries are evicted when their total
+    size exceeds max_size. Thread-safe (clangd highlights run in threads).
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # absolute path => entry, least recently used first
+        self.entries: OrderedDict[str, FileCacheEntry] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _entry(self, path: str) -> FileCacheEntry:
+        path = os.path.abspath(path)
+        stamp = file_stamp(os.stat(path))
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.stamp == stamp:
+                self.hits += 1
+                self.entries.move_to_end(path)
+                return entry
+            self.misses += 1
+
+        with open(path, "rb") as file:
+            # stamp of what is actually read
+            entry = FileCacheEntry(file_stamp(os.fstat(file.fileno())), file.read())
+
+        with self.lock:
+            self._remove(path)
+            if entry.size() <= self.max_size:
+                self.entries[path] = entry
+                self.size += entry.size()
+                self._evict()
+        return entry
+
+    def _remove(self, path: str) -> None:
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry.size()
+
+    def _evict(self) -> None:
+        while self.size > self.max_size:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size()
+
+    def read_bytes(self, path: str) -> bytes:
+        return self._entry(path).data
+
+    # decoded just like a file opened in text mode (UTF-8, universal newlines)
+    def read_text(self, path: str) -> str:
+        entry = self._entry(path)
+        text = entry.text
+        if text is None:
+            text = entry.data.decode("utf-8")
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            with self.lock:
+                if entry.text is None:
+                    old_size = entry.size()
+                    entry.text = text
+                    if self.entries.get(os.path.abspath(path)) is entry:
+                        self.size += entry.size() - old_size
+                        self._evict()
+        return text
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        return (f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+            f"{len(self.entries)} files, {self.size / (1024 * 1024):.1f} MiB")
+
+
+FILE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+file_cache = FileCache(FILE_CACHE_MAX_SIZE)
+
+
 def read_file(path: str) -> str:
-    with open(path, 'r', encoding="utf-8") as file:
-        return file.read()
+    return file_cache.read_text(path)
+
+
+def read_file_bytes(path: str) -> bytes:
+    return file_cache.read_bytes(path)
@@ -8,6 +8,7 @@ from nikola.post import Post
 from nikola.utils import get_logger
 
 from plugins.metadata import PageDir, split_path
+from plugins.tracing import span
 
 class IndexGenerationShortcode(ShortcodePlugin):
     """Generates website structure. Requires SiteMetadata attribute in site."""
@@ -51,7 +52,8 @@ class IndexGenerationShortcode(ShortcodePlugin):
                 index_root = index_root.enter(directory_name)
 
         self.logger.info(f"generating index structure for {post.permalink()} that starts in {index_path}")
-        html_result: str = generate_hierarchical_html(index_root, depth)
+        with span("index shortcode", page=post.permalink()):
+            html_result: str = generate_hierarchical_html(index_root, depth)
 
         # We need to regenerate indexes every time a page is added or removed.
         # We can not return wildcard paths or generally - paths which do not exist
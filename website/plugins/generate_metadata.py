@@ -5,6 +5,7 @@ from nikola.utils import get_logger
 from nikola.nikola import Nikola
 
 from plugins.metadata import SiteMetadata, PageMetadata
+from plugins.tracing import span
 
 class MetadataGenerator(SignalHandler):
     """
@@ -24,12 +25,14 @@ class MetadataGenerator(SignalHandler):
 
     def add_metadata(self, event) -> None:
         self.logger.info("generating metadata for the site")
-        metadata = SiteMetadata(self.site)
+        with span("site metadata generation"):
+            metadata = SiteMetadata(self.site)
         self.site.GLOBAL_CONTEXT["metadata"] = metadata
 
-        for page in self.site.pages:
-            self.logger.info(f"generating metadata for page {page.permalink()}")
-            page.metadata = PageMetadata(page, metadata)
+        with span("page metadata generation", pages=len(self.site.pages)):
+            for page in self.site.pages:
+                self.logger.info(f"generating metadata for page {page.permalink()}")
+                page.metadata = PageMetadata(page, metadata)
 
 
     def set_site(self, site: Nikola) -> None:
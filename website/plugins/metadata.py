@@ -1,6 +1,7 @@
 # https://stackoverflow.com/questions/33533148
 from __future__ import annotations
-from typing import List, Optional
+from bisect import bisect_left
+from typing import Dict, List, Optional
 
 from nikola.post import Post
 from nikola.nikola import Nikola
@@ -8,11 +9,12 @@ from nikola.utils import get_logger
 
 class SiteMetadata:
     def __init__(self, site: Nikola):
+        self._pages_by_permalink = index_pages_by_permalink(site.pages)
         self._structure = parse_site_structure(site.pages)
         self._structure.sort()
         log_correctness(self.structure())
         self._sidebar = make_sidebar()
-        verify_sidebar(self.sidebar(), site.pages)
+        verify_sidebar(self.sidebar(), self)
 
     def __repr__(self) -> str:
         lines: List[str] = []
@@ -25,6 +27,19 @@ class SiteMetadata:
     def sidebar(self) -> Sidebar:
         return self._sidebar
 
+    def page(self, permalink: str) -> Optional[Post]:
+        """Return the page with the given permalink (note: permalinks end with "/") or None."""
+        return self._pages_by_permalink.get(permalink)
+
+def index_pages_by_permalink(pages: List[Post]) -> Dict[str, Post]:
+    result: Dict[str, Post] = {}
+    for page in pages:
+        permalink = page.permalink()
+        if permalink in result:
+            get_logger(__name__).error(f'pages "{result[permalink].source_path}" and "{page.source_path}" have the same permalink "{permalink}"')
+        result[permalink] = page
+    return result
+
 def log_correctness(root_dir: PageDir) -> None:
     """
     Check and log any suspicions in the structure
@@ -69,7 +84,10 @@ class PageDir:
         self._directory_name = directory_name
         self._index_page = index_page
         self._pages: List[Post] = []
+        # sorted by name, names are indexed for lookups
         self._subdirs: List[PageDir] = []
+        self._subdir_names: List[str] = []
+        self._subdirs_by_name: Dict[str, PageDir] = {}
 
     def directory_name(self) -> str:
         return self._directory_name
@@ -84,29 +102,34 @@ class PageDir:
     def pages(self) -> List[Post]:
         return self._pages
 
+    # sorted by directory name, do not modify (use enter_or_create)
     def subdirs(self) -> List[PageDir]:
         return self._subdirs
 
+    # subdirectories are always sorted, only pages need sorting
     def sort(self) -> None:
         self._pages.sort(key=lambda page: page.permalink())
-        self._subdirs.sort(key=lambda subdir: subdir.directory_name())
         for subdir in self.subdirs():
             subdir.sort()
 
     def enter_or_create(self, directory_name: str) -> PageDir:
         """Return a nested directory object. If it does not exist, create one and then return it."""
-        for subdir in self.subdirs():
-            if subdir.directory_name() == directory_name:
-                return subdir
+        subdir = self._subdirs_by_name.get(directory_name)
+        if subdir is not None:
+            return subdir
 
-        self.subdirs().append(PageDir(directory_name))
-        return self.subdirs()[-1]
+        subdir = PageDir(directory_name)
+        i = bisect_left(self._subdir_names, directory_name)
+        self._subdir_names.insert(i, directory_name)
+        self._subdirs.insert(i, subdir)
+        self._subdirs_by_name[directory_name] = subdir
+        return subdir
 
     def enter(self, directory_name: str) -> PageDir:
         """Return a nested directory object. If it does not exist, raise an exception"""
-        for subdir in self.subdirs():
-            if subdir.directory_name() == directory_name:
-                return subdir
+        subdir = self._subdirs_by_name.get(directory_name)
+        if subdir is not None:
+            return subdir
 
         raise RuntimeError(f'Directory "{self.directory_name()}" has no child directory "{directory_name}"!')
 
@@ -281,7 +304,7 @@ class SidebarPage:
     def link(self) -> str:
         return self._link
 
-def verify_sidebar(sidebar: Sidebar, all_pages: List[Post]):
+def verify_sidebar(sidebar: Sidebar, site_metadata: SiteMetadata):
     logger = get_logger(__name__)
 
     for section in sidebar.sections():
@@ -296,14 +319,8 @@ def verify_sidebar(sidebar: Sidebar, all_pages: List[Post]):
             if page.link() == "":
                 logger.warning(f'page "{page.title()}" in sidebar section "{section.title()}" has empty link')
 
-            page_found = False
-            for p in all_pages:
-                # for unknown reason, permalinks end with "/"
-                if page.link() == p.permalink():
-                    page_found = True
-                    break
-
-            if not page_found:
+            # for unknown reason, permalinks end with "/"
+            if site_metadata.page(page.link()) is None:
                 logger.warning(f'sidebar page "{page.title()}" link "{page.link()}" is invalid')
 
 def make_sidebar() -> Sidebar:
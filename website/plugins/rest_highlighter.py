@@ -18,12 +18,24 @@ from docutils.parsers.rst import Directive, directives, roles
 from nikola.plugin_categories import RestExtension
 from nikola.utils import get_logger
 
-from plugins.file_utils import is_relative_path, make_path_absolute, path_description, read_file
+from plugins.file_utils import file_cache, is_relative_path, make_path_absolute, path_description, read_file, read_file_bytes
 
-from typing import Any, Dict, Optional
+from blinker import signal
 
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import atexit
+import hashlib
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
+import re
 import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
 try:
     # THIS IS BAD but works whenever ACH is rebuilt
@@ -38,12 +50,17 @@ import ansi2html
 from importlib.metadata import version
 
 from plugins.html_utils import escape_text_into_html
-from plugins.clangd import Clangd
+from plugins.cache_utils import CACHE_PATH, DiskCache, StringTable, hash_strings
+from plugins.clangd import ClangdLaunchProfile, ClangdPool, SemanticTokensCache
+from plugins.tracing import span
 
 ##############################################################################
 # utilities
 ##############################################################################
 
+def ach_version() -> str:
+    return ".".join(str(i) for i in pyach.version())
+
 def enclose_in_html(text: str, html_tag: str, css_classes: Optional[str] = None) -> str:
     if css_classes:
         return f'<{html_tag} class="{css_classes}">{text}</{html_tag}>'
@@ -67,14 +84,24 @@ class RestHighlighter(RestExtension):
 
         logger = get_logger(__name__)
         if pyach:
-            logger.info(f"using ACH version {'.'.join(str(i) for i in pyach.version())}")
-            inline_codes = load_inline_codes()
+            logger.info(f"using ACH version {ach_version()}")
+            with span("load inline codes"):
+                inline_codes = load_inline_codes()
             logger.info(f"loaded inline codes: {len(inline_codes)} lines")
         else:
             logger.error("failed to import ACH extension, cch roles and directives will output raw (colorless) code")
             inline_codes = None
         logger.info(f"using ansi2html version {version('ansi2html')}")
 
+        try:
+            clangd_profile = ClangdLaunchProfile.from_config(site.config.get("CLANGD_LAUNCH_PROFILE"))
+        except RuntimeError as err:
+            logger.error(str(err))
+            clangd_profile = ClangdLaunchProfile()
+        # clangd is started on the first use of the directive - many commands (check, serve,
+        # builds with everything up to date) load plugins but never highlight anything
+        CustomCodeHighlight.clangd_profile = clangd_profile
+
         # custom directives need to register a class that implements certain members
         # custom roles need to register a function - because we need to pass some state
         # to the function we pass a class instance that has implemented __call__ instead
@@ -82,8 +109,27 @@ class RestHighlighter(RestExtension):
         roles.register_local_role('cch', CustomCodeHighlightInline(inline_codes))
         directives.register_directive('ansi', AnsiHighlight)
 
+        # doit workers are forked and exit without atexit handlers - the main process trims
+        atexit.register(finish_caches)
+
+        # cch directives of all pages are known once Nikola has scanned files
+        self.scanned = signal('scanned')
+        self.scanned.connect(self.find_cch_directives)
+
         return super().set_site(site)
 
+    def find_cch_directives(self, event) -> None:
+        keys = []
+        with span("find cch directives"):
+            for post in self.site.timeline:
+                rst_source_path = post.source_path
+                if not rst_source_path.endswith(".rst"):
+                    continue
+                with open(rst_source_path, "r", encoding="utf-8-sig") as file:
+                    rst_source = file.read()
+                keys.extend(cch_key(rst_source_path, options) for options in find_cch_directives(rst_source))
+        CustomCodeHighlight.prehighlighter.schedule(keys)
+
 ##############################################################################
 # CCH implementation
 ##############################################################################
@@ -98,23 +144,31 @@ KEYWORDS_PATH = DATA_FILES_PATH + "/keywords.txt"
 HEADERS_PATH = DATA_FILES_PATH + "/headers.txt"
 INLINE_CODES_CODE_PATH = DATA_FILES_PATH + "/inline_codes.cpp"
 INLINE_CODES_COLOR_PATH = DATA_FILES_PATH + "/inline_codes.color"
+INLINE_CODES_SOURCE_PATHS = (KEYWORDS_PATH, HEADERS_PATH, INLINE_CODES_CODE_PATH, INLINE_CODES_COLOR_PATH)
+# highlighted inline codes, shared (memory-mapped) by all build processes
+INLINE_CODES_TABLE_PATH = os.path.join(CACHE_PATH, "inline_codes.table")
 KEYWORDS_LIST = read_file(KEYWORDS_PATH).splitlines()
+# mirror highlights of cch directives (they do not change unless code or color changes)
+MIRROR_HIGHLIGHT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+mirror_highlight_cache = DiskCache("mirror_highlight", "html", max_size=MIRROR_HIGHLIGHT_CACHE_MAX_SIZE)
 
 def run_mirror_highlighter_inline(code: str, color: str) -> str:
     highlighted = pyach.run_mirror_highlighter(code, color,
         replace=True, valid_css_classes=VALID_CSS_CLASSES)
     return enclose_in_html(highlighted, "code", "code custom-cpp")
 
-def inline_codes_add_entry(inline_codes: Dict[str, str], code: str, color: str, line: int):
-    logger = get_logger(__name__)
-    try:
-        if inline_codes.get(code):
-            logger.error(f'duplicate inline code defined: "{code}"')
-        inline_codes[code] = run_mirror_highlighter_inline(code, color)
-    except RuntimeError as err:
-        logger.error(f'inline code highlight failed [line = {line}]:\n{str(err)}')
+# inline codes with explicit color (code$$$color) are not predefined but pages repeat them
+run_mirror_highlighter_inline_memoized = lru_cache(maxsize=1024)(run_mirror_highlighter_inline)
+
+# code => (color, line in its source file)
+InlineCodeSources = Dict[str, Tuple[str, int]]
 
-def load_inline_codes() -> Dict[str, str]:
+def inline_code_sources_add_entry(sources: InlineCodeSources, code: str, color: str, line: int):
+    if code in sources:
+        get_logger(__name__).error(f'duplicate inline code defined: "{code}"')
+    sources[code] = (color, line)
+
+def load_inline_code_sources() -> InlineCodeSources:
     headers = read_file(HEADERS_PATH).splitlines()
     code_lines = read_file(INLINE_CODES_CODE_PATH).splitlines()
     color_lines = read_file(INLINE_CODES_COLOR_PATH).splitlines()
@@ -127,38 +181,116 @@ def load_inline_codes() -> Dict[str, str]:
     result = {}
 
     for i, code in enumerate(KEYWORDS_LIST, 1):
-        inline_codes_add_entry(result, code, "keyword", i)
+        inline_code_sources_add_entry(result, code, "keyword", i)
 
     for i, code in enumerate(headers, 1):
-        inline_codes_add_entry(result, code, "0pp_header", i)
+        inline_code_sources_add_entry(result, code, "0pp_header", i)
 
     for i, code in enumerate(headers, 1):
-        inline_codes_add_entry(result, f"#include {code}", "1pp_hash`pp_directive 0pp_header", i)
+        inline_code_sources_add_entry(result, f"#include {code}", "1pp_hash`pp_directive 0pp_header", i)
 
     for i, (code, color) in enumerate(zip(code_lines, color_lines), 1):
-        inline_codes_add_entry(result, code, color, i)
-
-    # workaround for some totally obscure bug, probably within docutils
-    # problem: some inline directives with backslashes are incorrectly parsed,
-    # they contain additional null characters for no reason
-    # example: :directive:`'\0'`    gives ["'", "\0", "0", "'"]
-    # example: :directive:`'\\0'`   gives ["'", "\0", "\\", "0", "'"]
-    # example: :directive:`'\\\0'`  gives ["'", "\0", "\\", "\0", "0", "'"]
-    # example: :directive:`'\\\\0'` gives ["'", "\0", "\\", "\0", "\\" ,"0", "'"]
-    # right now there are only few affected strings so just adding their corrupted versions
-    # as a copies of the proper ones
-    result["\0\\0"] = result.get("\\0")
-    result["\0\\n"] = result.get("\\n")
-    result["\0\\r"] = result.get("\\r")
-    result["'\0\\0'"] = result.get("'\\0'")
-    result["'\0\\n'"] = result.get("'\\n'")
-    result["'\0\\r'"] = result.get("'\\r'")
+        inline_code_sources_add_entry(result, code, color, i)
 
     return result
 
+# workaround for some totally obscure bug, probably within docutils
+# problem: some inline directives with backslashes are incorrectly parsed,
+# they contain additional null characters for no reason
+# example: :directive:`'\0'`    gives ["'", "\0", "0", "'"]
+# example: :directive:`'\\0'`   gives ["'", "\0", "\\", "0", "'"]
+# example: :directive:`'\\\0'`  gives ["'", "\0", "\\", "\0", "0", "'"]
+# example: :directive:`'\\\\0'` gives ["'", "\0", "\\", "\0", "\\" ,"0", "'"]
+# right now there are only few affected strings so just treating their corrupted versions
+# as aliases of the proper ones
+INLINE_CODE_ALIASES = {
+    "\0\\0": "\\0",
+    "\0\\n": "\\n",
+    "\0\\r": "\\r",
+    "'\0\\0'": "'\\0'",
+    "'\0\\n'": "'\\n'",
+    "'\0\\r'": "'\\r'",
+}
+
+# everything that affects highlighted inline codes
+def inline_codes_key() -> str:
+    parts = [ach_version(), VALID_CSS_CLASSES]
+    for path in INLINE_CODES_SOURCE_PATHS:
+        parts.extend((path, read_file(path)))
+    return hash_strings(*parts)
+
+class InlineCodes:
+    """
+    Mapping of predefined inline codes to their HTML, highlighted on first lookup
+
+    Entries highlighted in previous builds come from a memory-mapped table (if it has been
+    built from the same sources). New entries are added to the table at exit, so startup
+    cost does not depend on the number of predefined inline codes, only on what pages use.
+    """
+
+    def __init__(self, key: str, sources: InlineCodeSources, table: Optional[StringTable]):
+        self.key = key
+        self.sources = sources
+        self.table = table
+        # code => HTML (None if highlight failed)
+        self.highlighted: Dict[str, Optional[str]] = {}
+        # doit workers are forked and exit with os._exit (no atexit handlers)
+        atexit.register(self.save)
+        multiprocessing.util.register_after_fork(self, InlineCodes.after_fork)
+
+    def after_fork(self) -> None:
+        multiprocessing.util.Finalize(self, InlineCodes.save, args=(self,), exitpriority=0)
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def get(self, code: str) -> Optional[str]:
+        code = INLINE_CODE_ALIASES.get(code, code)
+        if self.table is not None:
+            html = self.table.get(code)
+            if html is not None:
+                return html
+
+        if code in self.highlighted:
+            return self.highlighted[code]
+
+        source = self.sources.get(code)
+        if source is None:
+            return None
+
+        color, line = source
+        try:
+            html = run_mirror_highlighter_inline(code, color)
+        except RuntimeError as err:
+            get_logger(__name__).error(f'inline code highlight failed [line = {line}]:\n{str(err)}')
+            html = None
+        self.highlighted[code] = html
+        return html
+
+    def save(self) -> None:
+        new_entries = {code: html for code, html in self.highlighted.items() if html is not None}
+        if not new_entries:
+            return
+
+        # other processes (doit workers) may have saved their entries in the meantime - merge with
+        # the current table; entries lost in a race are simply highlighted again in the next build
+        previous = StringTable.open(INLINE_CODES_TABLE_PATH, self.key) or self.table
+        entries = {code: previous.get(code) for code in previous} if previous is not None else {}
+        entries.update(new_entries)
+        try:
+            StringTable.write(INLINE_CODES_TABLE_PATH, self.key, entries)
+        except OSError as err:
+            get_logger(__name__).warning(f"failed to save inline codes: {str(err)}")
+            return
+        self.highlighted.clear()
+
+def load_inline_codes() -> InlineCodes:
+    key = inline_codes_key()
+    return InlineCodes(key, load_inline_code_sources(), StringTable.open(INLINE_CODES_TABLE_PATH, key))
+
 class CustomCodeHighlightInline:
     # inline_codes should be already a mapping of code strings to output strings
-    def __init__(self, inline_codes: Optional[Dict[str, str]]):
+    def __init__(self, inline_codes: Optional[InlineCodes]):
         self.inline_codes = inline_codes
 
     def __call__(self, name, rawtext, text, lineno, inliner, options={}, content=[]):
@@ -177,7 +309,7 @@ class CustomCodeHighlightInline:
                 prb = inliner.problematic(rawtext, rawtext, msg)
                 return [prb], [msg]
             try:
-                html_output = run_mirror_highlighter_inline(l[0], l[1])
+                html_output = run_mirror_highlighter_inline_memoized(l[0], l[1])
                 return [nodes.raw('', html_output, format='html')], []
             except RuntimeError as err:
                 get_logger(__name__).error(f'inline code with $$$: highlight failed:\n{str(err)}')
@@ -202,10 +334,373 @@ class CustomCodeHighlightInline:
 def passthrough(value: Any) -> Any:
     return value
 
+# line_start and line_end are 1-based and inclusive, the result is 0-based [first, last)
+def excerpt_line_range(line_start: Optional[int], line_end: Optional[int], num_lines: int) -> Tuple[int, int]:
+    first = (line_start or 1) - 1
+    last = line_end or num_lines
+    if first >= last or last > num_lines:
+        raise RuntimeError(f"invalid line range: line_start = {line_start}, line_end = {line_end}, "
+            f"file has {num_lines} lines")
+    return first, last
+
+def excerpt_text(text: str, line_range: Optional[Tuple[int, int]]) -> str:
+    if line_range is None:
+        return text
+    first, last = line_range
+    return "".join(text.splitlines(keepends=True)[first:last])
+
 def fail_gracefully(result: str, css_class: str = "code"):
     result = enclose_in_html(escape_text_into_html(result), "pre", css_class)
     return [nodes.raw('', result, format='html')]
 
+# None if neither option is given (whole file)
+def options_line_range(text: str, line_start: Optional[int], line_end: Optional[int]) -> Optional[Tuple[int, int]]:
+    if line_start is None and line_end is None:
+        return None
+    return excerpt_line_range(line_start, line_end, len(text.splitlines()))
+
+# Output of a cch directive is determined by its options, resolved against the page that contains it:
+# ("mirror", code path, color path, lang) or ("clangd", code path, highlight_printf_formatting, line_start, line_end)
+def cch_key(rst_source_path: str, options: Dict[str, Any]) -> Tuple:
+    code_absolute_path = make_path_absolute(rst_source_path, options["code_path"])
+    color_path = options.get("color_path")
+    if not color_path:
+        return ("clangd", code_absolute_path, options.get("highlight_printf_formatting", False),
+            options.get("line_start"), options.get("line_end"))
+    return ("mirror", code_absolute_path, make_path_absolute(rst_source_path, color_path), options.get("lang", "custom-cpp"))
+
+# everything that affects the output of mirror highlight
+def mirror_highlight_key(code_absolute_path: str, color_absolute_path: str, lang: str) -> str:
+    return hash_strings(ach_version(), VALID_CSS_CLASSES, lang,
+        read_file(code_absolute_path), read_file(color_absolute_path))
+
+def highlight_mirror(code_absolute_path: str, color_absolute_path: str, lang: str) -> str:
+    key = mirror_highlight_key(code_absolute_path, color_absolute_path, lang)
+    result = mirror_highlight_cache.get(key)
+    if result is None:
+        result = highlight_mirror_uncached(code_absolute_path, color_absolute_path, lang, key)
+    return result
+
+# key is mirror_highlight_key of the arguments, the result is stored under it
+def highlight_mirror_uncached(code_absolute_path: str, color_absolute_path: str, lang: str, key: str) -> str:
+    code_str = read_file(code_absolute_path)
+    color_str = read_file(color_absolute_path)
+    with span("mirror highlight", file=code_absolute_path):
+        result = pyach.run_mirror_highlighter(code_str, color_str, table_wrap_css_class=lang,
+            replace=True, valid_css_classes=VALID_CSS_CLASSES)
+    mirror_highlight_cache.put(key, result)
+    return result
+
+def finish_caches() -> None:
+    logger = get_logger(__name__)
+    for name, cache in (("mirror highlight", mirror_highlight_cache), ("clangd highlight", clangd_highlight_cache),
+        ("ANSI", ansi_cache)):
+        if cache.hits + cache.misses == 0:
+            continue
+        removed = cache.trim()
+        logger.info(f"{name} cache: {cache.stats()}, {removed} entries evicted")
+    logger.info(f"file cache: {file_cache.stats()}")
+
+# requires clangd highlighter (CustomCodeHighlight.get_clangd_highlighter)
+def highlight_clangd(code_absolute_path: str, highlight_printf_formatting: bool,
+    line_start: Optional[int], line_end: Optional[int]) -> str:
+    file_content, table = clangd_highlighted_table(code_absolute_path, highlight_printf_formatting)
+    if line_start is None and line_end is None:
+        return table.html
+
+    first, last = excerpt_line_range(line_start, line_end, len(file_content.splitlines()))
+    return table.excerpt(first, last)
+
+TABLE_ROW_REGEX = re.compile(r"<tr[\s>].*?</tr>", re.DOTALL)
+TABLE_ROW_START_REGEX = re.compile(r"<tr[\s>]")
+
+class HighlightedTable:
+    """
+    Highlighted code wrapped in a table by ACH (1 row per line), any range of lines can be cut out
+
+    An excerpt keeps everything around the rows (the table and its CSS classes) and only the
+    rows of the selected lines - it looks exactly like the same lines of the whole file,
+    including their line numbers. Each row is complete HTML (ACH closes and reopens spans
+    of multi-line comments and strings at line boundaries), so no span needs to be repaired.
+
+    Rows are found only when the first excerpt is cut, so whole files do not depend on the
+    table layout. Cutting fails (instead of producing wrong lines) unless there is exactly
+    1 row per line and no row contains another one.
+    """
+
+    def __init__(self, html: str, num_lines: int):
+        self.html = html
+        self.num_lines = num_lines
+        self.row_starts: Optional[List[int]] = None
+        self.row_ends: Optional[List[int]] = None
+
+    def find_rows(self) -> None:
+        row_starts = []
+        row_ends = []
+        for match in TABLE_ROW_REGEX.finditer(self.html):
+            if TABLE_ROW_START_REGEX.search(match.group(), 1) is not None:
+                raise RuntimeError(f"highlighted code has a nested table row at offset {match.start()}, "
+                    "excerpts can not be cut from it")
+            row_starts.append(match.start())
+            row_ends.append(match.end())
+        if len(row_starts) != self.num_lines:
+            raise RuntimeError(f"highlighted code has {len(row_starts)} table rows but the file has "
+                f"{self.num_lines} lines, excerpts can not be cut from it")
+        self.row_starts = row_starts
+        self.row_ends = row_ends
+
+    # 0-based [first, last)
+    def excerpt(self, first: int, last: int) -> str:
+        if self.row_starts is None:
+            self.find_rows()
+        return (self.html[:self.row_starts[0]] + self.html[self.row_starts[first]:self.row_ends[last - 1]] +
+            self.html[self.row_ends[-1]:])
+
+# HTML of whole files highlighted by clangd, excerpts of all pages are cut from it
+CLANGD_HIGHLIGHT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+clangd_highlight_cache = DiskCache("clangd_highlight", "html", max_size=CLANGD_HIGHLIGHT_CACHE_MAX_SIZE)
+# (path, highlight_printf_formatting) => (file content, its highlight); also used by prehighlighter
+# threads - a file that is already being highlighted is waited for instead of highlighted again
+HIGHLIGHTED_TABLES_MEMO_LIMIT = 64
+highlighted_tables_lock = threading.Lock()
+highlighted_tables_memo: Dict[Tuple[str, bool], Tuple[str, HighlightedTable]] = OrderedDict()
+highlighted_tables_in_flight: Dict[Tuple[str, bool], Future] = {}
+
+def clangd_highlighted_table(code_absolute_path: str, highlight_printf_formatting: bool) -> Tuple[str, HighlightedTable]:
+    file_content = read_file(code_absolute_path)
+    memo_key = (code_absolute_path, highlight_printf_formatting)
+    with highlighted_tables_lock:
+        entry = highlighted_tables_memo.get(memo_key)
+        if entry is not None and entry[0] == file_content:
+            highlighted_tables_memo.move_to_end(memo_key)
+            return entry
+        future = highlighted_tables_in_flight.get(memo_key)
+        if future is None:
+            highlighted_tables_in_flight[memo_key] = Future()
+    if future is not None:
+        return future.result()
+
+    try:
+        entry = (file_content, HighlightedTable(
+            clangd_highlight_file(code_absolute_path, highlight_printf_formatting, file_content),
+            len(file_content.splitlines())))
+    except BaseException as err:
+        with highlighted_tables_lock:
+            future = highlighted_tables_in_flight.pop(memo_key)
+        future.set_exception(err)
+        raise
+
+    with highlighted_tables_lock:
+        future = highlighted_tables_in_flight.pop(memo_key)
+        highlighted_tables_memo[memo_key] = entry
+        while len(highlighted_tables_memo) > HIGHLIGHTED_TABLES_MEMO_LIMIT:
+            highlighted_tables_memo.popitem(last=False)
+    future.set_result(entry)
+    return entry
+
+# everything that affects the HTML of a whole file highlighted by clangd
+def clangd_highlight_key(file_content: str, highlight_printf_formatting: bool) -> str:
+    # semantic tokens key covers file content and clangd, the rest is ACH
+    return hash_strings(ach_version(), CustomCodeHighlight.clangd_cache.key(file_content),
+        str(highlight_printf_formatting), "codetable")
+
+def clangd_highlight_file(code_absolute_path: str, highlight_printf_formatting: bool, file_content: str) -> str:
+    key = clangd_highlight_key(file_content, highlight_printf_formatting)
+    html = clangd_highlight_cache.get(key)
+    if html is not None:
+        return html
+
+    # on semantic tokens cache hit clangd is not queried at all
+    with span("clangd semantic tokens", file=code_absolute_path):
+        file_content, semantic_tokens = CustomCodeHighlight.clangd_cache.file_content_and_semantic_tokens_with_color_variance(
+            CustomCodeHighlight.get_clangd, code_absolute_path)
+    with span("ACH run", file=code_absolute_path):
+        html = CustomCodeHighlight.clangd_highlighter.run(
+            file_content,
+            semantic_tokens=semantic_tokens,
+            table_wrap_css_class="custom-cpp",
+            highlight_printf_formatting=highlight_printf_formatting)
+    clangd_highlight_cache.put(clangd_highlight_key(file_content, highlight_printf_formatting), html)
+    return html
+
+CCH_DIRECTIVE_REGEX = re.compile(r"^[ \t]*\.\. cch::[ \t]*$")
+CCH_OPTION_REGEX = re.compile(r"^[ \t]+:(?P<name>\w+):(?P<value>.*)$")
+
+# options of all cch directives in reST source, converted just like docutils does
+# (directives with invalid options are skipped - docutils will report them)
+def find_cch_directives(rst_source: str) -> List[Dict[str, Any]]:
+    result = []
+    lines = rst_source.splitlines()
+    for i, line in enumerate(lines):
+        if not CCH_DIRECTIVE_REGEX.match(line):
+            continue
+
+        options = {}
+        try:
+            for option_line in lines[i + 1:]:
+                match = CCH_OPTION_REGEX.match(option_line)
+                if match is None:
+                    break
+                value = match.group("value").strip()
+                options[match.group("name")] = CustomCodeHighlight.option_spec[match.group("name")](value or None)
+            if "code_path" in options:
+                result.append(options)
+        except (KeyError, ValueError, TypeError):
+            pass
+    return result
+
+# Jobs handed to an executor are always completed before the process exits (executor threads
+# are joined before atexit handlers run) - only this many per worker are handed over at
+# a time, the rest is dropped on exit.
+PREHIGHLIGHT_JOBS_PER_WORKER = 2
+
+# (future for the result, function, its arguments)
+PrehighlightJob = Tuple[Future, Callable, Tuple]
+
+class Prehighlighter:
+    """
+    Highlights code of cch directives of the site in parallel, before pages need it
+
+    docutils runs directives serially, in document order. Directives of all pages are found
+    when Nikola scans the site but highlighting starts only when the first cch directive
+    runs (commands that do not compile pages pay nothing). Only code whose highlight is not
+    cached is highlighted, so an incremental build (e.g. in "nikola auto") highlights only
+    what has changed and does not start clangd if all of its results are cached.
+
+    Mirror highlights run in a process pool (forked, where fork is not available directives
+    highlight on their own), clangd highlights (1 per file - excerpts are cut from it) in threads
+    that share the clangd pool. Directives then only wait for
+    their result. A directive whose job has not started yet highlights on its own.
+    """
+
+    def __init__(self):
+        self.keys: List[Tuple] = []
+        # cch key (mirror) or ("clangd", code path, highlight_printf_formatting) => result
+        self.results: Dict[Tuple, Future] = {}
+        self.started = False
+        self.executors: List[Executor] = []
+        self.queues: List[Deque[PrehighlightJob]] = []
+
+    def schedule(self, keys: List[Tuple]) -> None:
+        if not self.started:
+            # pages may repeat the same code
+            self.keys = list(dict.fromkeys(keys))
+
+    def start(self) -> None:
+        self.started = True
+        # doit workers (doit -n) already compile pages in parallel processes
+        if pyach is None or multiprocessing.parent_process() is not None:
+            return
+
+        mirror_jobs = []
+        for key in self.keys:
+            if key[0] != "mirror":
+                continue
+            try:
+                cache_key = mirror_highlight_key(*key[1:])
+            except Exception:
+                continue # the directive will report it
+            if not mirror_highlight_cache.contains(cache_key):
+                mirror_jobs.append((key, highlight_mirror_uncached, (*key[1:], cache_key)))
+
+        # Workers must be forked: they use ACH and caches of this (already loaded) plugin. Where
+        # fork is not available (e.g. Windows), directives highlight on their own instead.
+        # Processes are forked upon first submit - before clangd (and its threads) is started.
+        if "fork" not in multiprocessing.get_all_start_methods():
+            mirror_jobs = []
+        if mirror_jobs:
+            workers = os.cpu_count() or 1
+            self.run(ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")),
+                workers, mirror_jobs)
+
+        clangd_jobs = []
+        clangd_files = dict.fromkeys(key[1:3] for key in self.keys if key[0] == "clangd")
+        # starts clangd only if the token legend is not cached (then nothing is)
+        if clangd_files and CustomCodeHighlight.get_clangd_highlighter() is not None:
+            for code_absolute_path, highlight_printf_formatting in clangd_files:
+                try:
+                    cache_key = clangd_highlight_key(read_file(code_absolute_path), highlight_printf_formatting)
+                except Exception:
+                    continue # the directive will report it
+                if not clangd_highlight_cache.contains(cache_key):
+                    clangd_jobs.append((("clangd", code_absolute_path, highlight_printf_formatting),
+                        clangd_highlighted_table, (code_absolute_path, highlight_printf_formatting)))
+
+        if clangd_jobs:
+            # as many threads as clangd processes in the pool
+            workers = os.cpu_count() or 1
+            self.run(ThreadPoolExecutor(max_workers=workers), workers, clangd_jobs)
+
+        get_logger(__name__).info(f"prehighlighting {len(mirror_jobs)} mirror and {len(clangd_jobs)} clangd code snippets "
+            f"(not cached)")
+        if self.executors:
+            atexit.register(self.shutdown)
+
+    def run(self, executor: Executor, workers: int, jobs: List[Tuple[Tuple, Callable, Tuple]]) -> None:
+        self.executors.append(executor)
+        queue: Deque[PrehighlightJob] = deque()
+        for key, function, args in jobs:
+            self.results[key] = Future()
+            queue.append((self.results[key], function, args))
+        self.queues.append(queue)
+        for _ in range(workers * PREHIGHLIGHT_JOBS_PER_WORKER):
+            self.submit_next(executor, queue)
+
+    # called again each time a job finishes (from executor threads)
+    def submit_next(self, executor: Executor, queue: Deque[PrehighlightJob]) -> None:
+        while True:
+            try:
+                result, function, args = queue.popleft()
+            except IndexError:
+                return
+            # cancelled: the directive has highlighted on its own
+            if result.set_running_or_notify_cancel():
+                break
+
+        try:
+            job = executor.submit(function, *args)
+        except RuntimeError as err: # interpreter or executor shutdown
+            result.set_exception(err)
+            return
+        job.add_done_callback(lambda job: self.job_done(job, result, executor, queue))
+
+    def job_done(self, job: Future, result: Future, executor: Executor, queue: Deque[PrehighlightJob]) -> None:
+        if job.cancelled():
+            result.set_exception(RuntimeError("prehighlight has been cancelled"))
+        elif job.exception() is not None:
+            result.set_exception(job.exception())
+        else:
+            result.set_result(job.result())
+        self.submit_next(executor, queue)
+
+    # precomputed HTML, None if the directive should highlight on its own (also in case
+    # of errors - the directive will report them); for clangd waits until the highlight
+    # of the whole file is ready, the directive then cuts its excerpt from it
+    def get(self, key: Tuple) -> Optional[str]:
+        if not self.started:
+            self.start()
+
+        result = self.results.get(key if key[0] == "mirror" else key[:3])
+        # not started yet - cancelled so that it's not highlighted twice
+        if result is None or result.cancel():
+            return None
+        try:
+            html = result.result()
+        except Exception:
+            return None
+        return html if key[0] == "mirror" else None
+
+    def shutdown(self) -> None:
+        for queue in self.queues:
+            while queue:
+                try:
+                    queue.popleft()[0].cancel()
+                except IndexError:
+                    break
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.executors.clear()
+
 class CustomCodeHighlight(Directive):
     # required by docutils
     has_content = False
@@ -216,61 +711,121 @@ class CustomCodeHighlight(Directive):
         "color_path": passthrough, # if present, use mirror highlight, otherwise use clangd
         "lang": passthrough,
         "highlight_printf_formatting": bool,
-        # ignored for now, intended for clangd highlight only
-        # TODO implement either here or in ACH, decide which side should do table wrap
+        # 1-based, inclusive; clangd highlight only (ignored by mirror highlight)
         "line_start": directives.positive_int,
         "line_end": directives.positive_int
     }
 
     # for internal purposes
-    try:
-        if pyach is None:
-            raise RuntimeError("ACH not present")
-        clangd = Clangd()
-        clangd_highlighter = pyach.ClangdHighlighter(clangd.semantic_token_types, clangd.semantic_token_modifiers, KEYWORDS_LIST)
-    except (RuntimeError, ValueError) as err:
-        clangd = None
-        clangd_highlighter = None
-        logger = get_logger(__name__)
-        logger.error(str(err))
-        logger.warning("website build will function but clangd-based highlight will be disabled")
+    clangd_profile = ClangdLaunchProfile()
+    # clangd objects are created lazily, also from prehighlighter threads
+    clangd_lock = threading.RLock()
+    clangd_started = False
+    clangd = None
+    clangd_highlighter_started = False
+    clangd_cache = None
+    clangd_highlighter = None
+    prehighlighter = Prehighlighter()
+
+    # clangd processes are started only when semantic tokens of some file are not cached
+    @staticmethod
+    def get_clangd() -> Optional[ClangdPool]:
+        with CustomCodeHighlight.clangd_lock:
+            # start at most once - if it failed, the error has already been reported
+            if not CustomCodeHighlight.clangd_started:
+                CustomCodeHighlight.clangd_started = True
+                with span("clangd pool start"):
+                    CustomCodeHighlight.start_clangd(CustomCodeHighlight.clangd_profile)
+                if CustomCodeHighlight.clangd is not None:
+                    atexit.register(CustomCodeHighlight.stop_clangd)
+            return CustomCodeHighlight.clangd
+
+    # the highlighter needs only the token legend, which is persisted by the cache
+    @staticmethod
+    def get_clangd_highlighter():
+        with CustomCodeHighlight.clangd_lock:
+            if not CustomCodeHighlight.clangd_highlighter_started:
+                CustomCodeHighlight.clangd_highlighter_started = True
+                CustomCodeHighlight.start_clangd_highlighter(CustomCodeHighlight.clangd_profile)
+            return CustomCodeHighlight.clangd_highlighter
+
+    @staticmethod
+    def stop_clangd() -> None:
+        with CustomCodeHighlight.clangd_lock:
+            clangd = CustomCodeHighlight.clangd
+            CustomCodeHighlight.clangd = None
+        if clangd is not None:
+            clangd.shutdown()
+
+    @staticmethod
+    def start_clangd(profile: ClangdLaunchProfile) -> None:
+        try:
+            CustomCodeHighlight.clangd = ClangdPool(profile=profile)
+            if CustomCodeHighlight.clangd_cache is not None:
+                CustomCodeHighlight.clangd_cache.put_legend(
+                    CustomCodeHighlight.clangd.semantic_token_types, CustomCodeHighlight.clangd.semantic_token_modifiers)
+        except (RuntimeError, ValueError) as err:
+            CustomCodeHighlight.clangd = None
+            logger = get_logger(__name__)
+            logger.error(str(err))
+            logger.warning("website build will function but clangd-based highlight will be disabled")
+
+    @staticmethod
+    def start_clangd_highlighter(profile: ClangdLaunchProfile) -> None:
+        try:
+            if pyach is None:
+                raise RuntimeError("ACH not present")
+            CustomCodeHighlight.clangd_cache = SemanticTokensCache(profile)
+            legend = CustomCodeHighlight.clangd_cache.legend()
+            if legend is None:
+                clangd = CustomCodeHighlight.get_clangd()
+                if clangd is None:
+                    CustomCodeHighlight.clangd_cache = None
+                    return # already reported
+                legend = (clangd.semantic_token_types, clangd.semantic_token_modifiers)
+            CustomCodeHighlight.clangd_highlighter = pyach.ClangdHighlighter(*legend, KEYWORDS_LIST)
+        except (RuntimeError, ValueError) as err:
+            CustomCodeHighlight.clangd_cache = None
+            CustomCodeHighlight.clangd_highlighter = None
+            logger = get_logger(__name__)
+            logger.error(str(err))
+            logger.warning("website build will function but clangd-based highlight will be disabled")
 
     def run(self):
         code_path = self.options["code_path"]
         color_path = self.options.get("color_path")
         rst_source_path = self.state.document.settings._nikola_source_path
-        code_absolute_path = make_path_absolute(rst_source_path, code_path)
+        key = cch_key(rst_source_path, self.options)
         # report dependency on used files - required to support incremental build
-        self.state.document.settings.record_dependencies.add(code_absolute_path)
+        self.state.document.settings.record_dependencies.add(key[1])
+
+        if key[0] == "mirror":
+            is_code_path_relative = is_relative_path(code_path)
+            is_color_path_relative = is_relative_path(color_path)
 
-        if not color_path:
-            return self.run_clangd_highlighter(code_absolute_path, self.options.get("highlight_printf_formatting", False))
+            if is_code_path_relative != is_color_path_relative:
+                get_logger(__name__).warn(f"{rst_source_path} called CCH extension with inconsistent paths: "
+                    f"{code_path} is {path_description(is_code_path_relative)} but "
+                    f"{color_path} is {path_description(is_color_path_relative)}")
 
-        is_code_path_relative = is_relative_path(code_path)
-        is_color_path_relative = is_relative_path(color_path)
+            self.state.document.settings.record_dependencies.add(key[2])
 
-        if is_code_path_relative != is_color_path_relative:
-            get_logger(__name__).warn(f"{rst_source_path} called CCH extension with inconsistent paths: "
-                f"{code_path} is {path_description(is_code_path_relative)} but "
-                f"{color_path} is {path_description(is_color_path_relative)}")
+        result = CustomCodeHighlight.prehighlighter.get(key)
+        if result is not None:
+            return [nodes.raw('', result, format='html')]
 
-        color_absolute_path = make_path_absolute(rst_source_path, color_path)
-        self.state.document.settings.record_dependencies.add(color_absolute_path)
-        lang = self.options.get("lang", "custom-cpp")
-        return self.run_mirror_highlighter(code_absolute_path, color_absolute_path, lang)
+        if key[0] == "clangd":
+            return self.run_clangd_highlighter(*key[1:])
+        return self.run_mirror_highlighter(*key[1:])
 
     def run_mirror_highlighter(self, code_absolute_path: str, color_absolute_path: str, lang: str):
         try:
-            code_str = read_file(code_absolute_path)
-            color_str = read_file(color_absolute_path)
-
             if pyach is None:
                 # fail gracefully with raw text
                 # problems are already reported when the plugin fails to initialize
-                return fail_gracefully(code_str, f"code {lang}")
+                return fail_gracefully(read_file(code_absolute_path), f"code {lang}")
 
-            result = pyach.run_mirror_highlighter(code_str, color_str, table_wrap_css_class=lang,
-                replace=True, valid_css_classes=VALID_CSS_CLASSES)
+            result = highlight_mirror(code_absolute_path, color_absolute_path, lang)
             return [nodes.raw('', result, format='html')]
         except Exception as err:
             # Log and return error_str instead of raise self.error(error_str) because
@@ -283,21 +838,16 @@ class CustomCodeHighlight(Directive):
             get_logger(__name__).error(error_str)
             return fail_gracefully(error_str)
 
-    def run_clangd_highlighter(self, code_absolute_path: str, highlight_printf_formatting: bool):
+    def run_clangd_highlighter(self, code_absolute_path: str, highlight_printf_formatting: bool,
+        line_start: Optional[int], line_end: Optional[int]):
         try:
-            lang = "custom-cpp"
-
-            if CustomCodeHighlight.clangd is None:
+            if CustomCodeHighlight.get_clangd_highlighter() is None:
                 # fail gracefully with raw text
-                # problems are already reported when the plugin fails to initialize
-                return fail_gracefully(read_file(code_absolute_path), f"code {lang}")
+                # problems are already reported when clangd fails to start
+                code_str = read_file(code_absolute_path)
+                return fail_gracefully(excerpt_text(code_str, options_line_range(code_str, line_start, line_end)), "code custom-cpp")
 
-            file_content, semantic_tokens = CustomCodeHighlight.clangd.file_content_and_semantic_tokens_with_color_variance(code_absolute_path)
-            result = CustomCodeHighlight.clangd_highlighter.run(
-                file_content,
-                semantic_tokens=semantic_tokens,
-                table_wrap_css_class=lang,
-                highlight_printf_formatting=highlight_printf_formatting)
+            result = highlight_clangd(code_absolute_path, highlight_printf_formatting, line_start, line_end)
             return [nodes.raw('', result, format='html')]
         except Exception as err:
             error_str = (f"clangd highlight failed:\n{str(err)}\ncode_path: {code_absolute_path}\n")
@@ -309,6 +859,114 @@ class CustomCodeHighlight(Directive):
 # ANSI implementation
 ##############################################################################
 
+# captures larger than this are converted in chunks of (about) this size
+ANSI_CHUNK_SIZE = 1024 * 1024
+ANSI_CACHE_MAX_SIZE = 64 * 1024 * 1024
+ansi_cache = DiskCache("ansi", "html", max_size=ANSI_CACHE_MAX_SIZE)
+
+# Select Graphic Rendition - the only escape sequences that carry state between lines
+SGR_REGEX = re.compile(r"\x1b\[([0-9;:]*)m")
+SGR_FULL_RESET = 0
+SGR_FOREGROUND = 38
+SGR_BACKGROUND = 48
+SGR_256_COLOR_ID = 5
+
+# attribute that each SGR code sets - later codes of the same attribute replace earlier ones
+# (same groups as in ansi2html, codes it does not support are ignored)
+SGR_ATTRIBUTES: Dict[int, str] = {
+    **dict.fromkeys((1, 2, 22), "intensity"),
+    **dict.fromkeys((3, 23), "style"),
+    **dict.fromkeys((4, 24), "underline"),
+    **dict.fromkeys((5, 6, 25), "blink"),
+    **dict.fromkeys((7, 27), "negative"),
+    **dict.fromkeys((8, 28), "visibility"),
+    **dict.fromkeys((9, 29), "crossed_out"),
+    **dict.fromkeys((*range(30, 40), *range(90, 98)), "foreground"),
+    **dict.fromkeys((*range(40, 50), *range(100, 108)), "background"),
+}
+
+# Updates attribute => SGR parameters that set its current value. Same rules as ansi2html:
+# 0 resets everything, except where it is a parameter of a color.
+def sgr_update(attributes: Dict[str, str], parameters: str) -> None:
+    try:
+        values = [int(x) for x in re.split("[;:]+", parameters)]
+    except ValueError:
+        attributes.clear()
+        return
+    i = 0
+    while i < len(values):
+        size = 1
+        if values[i] == SGR_FULL_RESET:
+            attributes.clear()
+        elif values[i] in (SGR_FOREGROUND, SGR_BACKGROUND):
+            size = 3 if i + 1 < len(values) and values[i + 1] == SGR_256_COLOR_ID else 5
+            attributes[SGR_ATTRIBUTES[values[i]]] = ";".join(str(value) for value in values[i:i + size])
+        elif values[i] in SGR_ATTRIBUTES:
+            attributes[SGR_ATTRIBUTES[values[i]]] = str(values[i])
+        i += size
+
+class AnsiStreamConverter:
+    """
+    Converts ANSI-escaped text to HTML in chunks that end on line boundaries
+
+    Each chunk is converted separately, prefixed with 1 SGR sequence that sets the attributes
+    in effect at the end of the previous chunk, so colors continue across chunks. Only the
+    current value of each attribute is kept, so the prefix stays short however long the text is.
+    Each chunk closes its <span> elements - the output differs from converting
+    the whole text at once only in where spans are split, not in how it renders.
+    Cursor movement does not cross chunk boundaries.
+    """
+
+    def __init__(self, converter: ansi2html.Ansi2HTMLConverter):
+        self.converter = converter
+        self.sgr_attributes: Dict[str, str] = {}
+
+    def convert(self, chunk: str) -> str:
+        prefix = ""
+        if self.sgr_attributes:
+            prefix = f"\x1b[{';'.join(self.sgr_attributes.values())}m"
+        for match in SGR_REGEX.finditer(chunk):
+            sgr_update(self.sgr_attributes, match.group(1))
+        # full=False disables HTML preamble - we want only <span> elements
+        return self.converter.convert(prefix + chunk, full=False)
+
+# decoded like text files are read (universal newlines), lines are never split
+def read_ansi_chunks(data: mmap.mmap, chunk_size: int):
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start + chunk_size)
+        end = len(data) if end == -1 else end + 1
+        yield data[start:end].decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+        start = end
+
+def convert_ansi_file(path: str, converter: ansi2html.Ansi2HTMLConverter) -> str:
+    if os.path.getsize(path) <= ANSI_CHUNK_SIZE:
+        # full=False disables HTML preamble - we want only <span> elements
+        return converter.convert(read_file(path), full=False)
+
+    stream = AnsiStreamConverter(converter)
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return "".join(stream.convert(chunk) for chunk in read_ansi_chunks(data, ANSI_CHUNK_SIZE))
+
+# everything that affects the output of ANSI conversion
+def ansi_key(path: str) -> str:
+    hasher = hashlib.sha256()
+    if os.path.getsize(path) <= ANSI_CHUNK_SIZE:
+        hasher.update(read_file_bytes(path))
+    else:
+        # large captures are hashed without reading them into memory
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            hasher.update(data)
+    return hash_strings(version('ansi2html'), "line_wrap=False", hasher.hexdigest())
+
+def highlight_ansi(path: str, converter: ansi2html.Ansi2HTMLConverter) -> str:
+    key = ansi_key(path)
+    result = ansi_cache.get(key)
+    if result is None:
+        result = convert_ansi_file(path, converter)
+        ansi_cache.put(key, result)
+    return result
+
 class AnsiHighlight(Directive):
     # required by docutils
     has_content = False
@@ -327,11 +985,8 @@ class AnsiHighlight(Directive):
         ansi_path = make_path_absolute(rst_source_path, ansi_path)
 
         try:
-            # full=False disables HTML preamble - we want only <span> elements
-            result = enclose_in_html(
-                AnsiHighlight.converter.convert(read_file(ansi_path), full=False),
-                "pre",
-                "code ansi")
+            with span("ANSI conversion", file=ansi_path):
+                result = enclose_in_html(highlight_ansi(ansi_path, AnsiHighlight.converter), "pre", "code ansi")
         except Exception as err:
             raise self.error(f'highlight failed:\n{str(err)}\nansi_path: {ansi_path}\n')
 
@@ -0,0 +1,107 @@
+import atexit
+import glob
+import json
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Optional
+
+from plugins.cache_utils import CACHE_PATH
+
+# Span tracer for finding where build time goes. With SITE_TRACE set, each process writes
+# its spans at exit to cache/trace/<pid>.json in Chrome trace event format (open it in
+# https://ui.perfetto.dev or chrome://tracing). Run "python -m plugins.tracing" (from the
+# directory with conf.py) to merge traces of all processes (doit workers) into cache/trace.json.
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+TRACE = os.environ.get("SITE_TRACE") is not None
+TRACE_PATH = os.path.join(CACHE_PATH, "trace")
+TRACE_MERGED_PATH = os.path.join(CACHE_PATH, "trace.json")
+
+class Tracer:
+    def __init__(self):
+        self.events: list[dict[str, Any]] = []
+        self.thread_names: dict[int, str] = {}
+
+    def add(self, event: dict[str, Any]) -> None:
+        tid = event["tid"]
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        # list.append is atomic - no lock needed for spans from multiple threads
+        self.events.append(event)
+
+    def write(self) -> Optional[str]:
+        if not self.events:
+            return None
+
+        pid = os.getpid()
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{os.path.basename(sys.argv[0])} ({pid})"}}]
+        metadata.extend({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self.thread_names.items())
+
+        os.makedirs(TRACE_PATH, exist_ok=True)
+        path = os.path.join(TRACE_PATH, f"{pid}.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": metadata + self.events}, file, indent=None, separators=(",", ":"))
+        return path
+
+    # multiprocessing workers (doit -n) are forked: they inherit parent's events and
+    # exit with os._exit - atexit handlers do not run but multiprocessing finalizers do
+    def after_fork(self) -> None:
+        self.events.clear()
+        self.thread_names.clear()
+        multiprocessing.util.Finalize(self, Tracer.write, args=(self,), exitpriority=0)
+
+tracer = Tracer()
+
+class Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: dict[str, Any]):
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        end = time.perf_counter_ns()
+        tracer.add({
+            "name": self.name,
+            "ph": "X", # complete event
+            "ts": self.start / 1000, # microseconds
+            "dur": (end - self.start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": self.args
+        })
+
+_NO_SPAN = nullcontext()
+
+# usage: with span("semantic tokens", file=path): ...
+# when tracing is disabled, returns a shared no-op context manager
+def span(name: str, **args: Any):
+    if not TRACE:
+        return _NO_SPAN
+    return Span(name, args)
+
+if TRACE:
+    atexit.register(tracer.write)
+    multiprocessing.util.register_after_fork(tracer, Tracer.after_fork)
+
+def merge_traces() -> int:
+    merged = []
+    paths = sorted(glob.glob(os.path.join(TRACE_PATH, "*.json")))
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as file:
+            merged.extend(json.load(file)["traceEvents"])
+    with open(TRACE_MERGED_PATH, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": merged}, file, indent=None, separators=(",", ":"))
+    return len(paths)
+
+if __name__ == "__main__":
+    print(f"merged {merge_traces()} traces into {TRACE_MERGED_PATH}")